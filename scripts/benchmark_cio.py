@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Jason Young (杨郑鑫).
+#
+# E-Mail: <AI.Jason.Young@outlook.com>
+# 2020-10-30 11:10
+#
+# This source code is licensed under the WTFPL license found in the
+# LICENSE file in the root directory of this source tree.
+
+
+import os
+import random
+import argparse
+
+from yoolkit.cio import mk_temp, rm_temp, open_file, load_lines
+from yoolkit.timer import Timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of yoolkit.cio readers and writers for each compression codec.')
+    parser.add_argument('--line-number', type=int, default=1000000)
+    parser.add_argument('--compress-level', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    words = [f'word{index}' for index in range(10000)]
+    lines = [' '.join(random.choices(words, k=random.randint(5, 30))) + '\n' for _ in range(args.line_number)]
+    plain_size = sum(len(line.encode('utf-8')) for line in lines) / (1024 * 1024)
+
+    temp_dir = mk_temp('yoolkit-benchmark-cio-', 'dir')
+    try:
+        for compression, extension in [(None, ''), ('gzip', '.gz'), ('bz2', '.bz2'), ('xz', '.xz')]:
+            file_path = os.path.join(temp_dir, f'lines.txt{extension}')
+
+            timer = Timer()
+            timer.launch()
+            with open_file(file_path, 'w', compress_level=args.compress_level) as file_object:
+                file_object.writelines(lines)
+            write_time = timer.standby()
+
+            timer = Timer()
+            timer.launch()
+            line_number = sum(1 for _ in load_lines(file_path))
+            read_time = timer.standby()
+            assert line_number == len(lines)
+
+            file_size = os.path.getsize(file_path) / (1024 * 1024)
+            print(
+                f'[{compression}] size: {file_size:.1f}MB (ratio {plain_size / file_size:.2f}); '
+                f'write: {plain_size / write_time:.1f}MB/s; read: {plain_size / read_time:.1f}MB/s'
+            )
+    finally:
+        rm_temp(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Jason Young (杨郑鑫).
+#
+# E-Mail: <AI.Jason.Young@outlook.com>
+# 2020-11-17 11:37
+#
+# This source code is licensed under the WTFPL license found in the
+# LICENSE file in the root directory of this source tree.
+
+
+import random
+import argparse
+
+from yoolkit.timer import Timer
+from yoolkit.levenshtein import Levenshtein
+
+
+def random_sequence(length, vocabulary_size):
+    return [f'w{random.randrange(vocabulary_size)}' for _ in range(length)]
+
+
+def benchmark(method, pairs):
+    timer = Timer()
+    timer.launch()
+    results = [method(source, target) for source, target in pairs]
+    return timer.standby(), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the distance engines of yoolkit.levenshtein with the full stage matrix DP.')
+    parser.add_argument('--pair-number', type=int, default=200)
+    parser.add_argument('--sequence-length', type=int, default=30)
+    parser.add_argument('--vocabulary-size', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    pairs = [
+        (random_sequence(args.sequence_length, args.vocabulary_size), random_sequence(args.sequence_length, args.vocabulary_size))
+        for _ in range(args.pair_number)
+    ]
+
+    for name, levenshtein in [('unit weights', Levenshtein()), ('custom weights', Levenshtein(2, 2, 3))]:
+        stage_matrix_time, stage_matrix_results = benchmark(lambda s, t: levenshtein.calculate_stage_matrix(s, t)[-1, -1], pairs)
+        engine_time, engine_results = benchmark(levenshtein.get_levenshtein_distance, pairs)
+        assert [int(r) for r in stage_matrix_results] == [int(r) for r in engine_results], 'Results are not identical!'
+        print(f'[{name}] stage matrix: {stage_matrix_time:.3f}s; distance engine: {engine_time:.3f}s; speedup: {stage_matrix_time / engine_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
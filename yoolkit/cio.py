@@ -12,10 +12,23 @@
 
 import io
 import os
+import bz2
+import gzip
+import lzma
+import mmap
+import heapq
+import queue
+import array
+import random
+import bisect
 import pickle
+import hashlib
 import tempfile
+import threading
 import itertools
 
+from yoolkit.timer import Timer
+
 
 def mk_temp(prefix, temp_type, location=tempfile.gettempdir()):
     assert temp_type in set({'dir', 'file'}), f'Invalid temp type: {temp_type} (Options: (\'dir\', \'file\'))'
@@ -34,47 +47,166 @@ def rm_temp(temp_path):
         os.remove(temp_path)
 
     if os.path.isdir(temp_path):
-        for child_temp_path in os.listdir(temp_path):
-            rm_temp(child_temp_path)
+        for child_temp_name in os.listdir(temp_path):
+            rm_temp(os.path.join(temp_path, child_temp_name))
         os.rmdir(temp_path)
 
 
-def dump_data(file_path, data_object):
-    with open(file_path, 'wb') as file_object:
-        pickle.dump(data_object, file_object)
+compression_extensions = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+}
 
 
-def load_data(file_path):
-    with open(file_path, 'rb') as file_object:
-        return pickle.load(file_object)
+# A bz2 stream starts with b'BZh', its block size ('1'-'9') and the magic of its first block (or of the end of an empty stream),
+# b'BZh' alone is too weak: plain text may start with it.
+compression_magic_numbers = {
+    b'\x1f\x8b': 'gzip',
+    **{
+        b'BZh' + block_size + block_magic: 'bz2'
+        for block_size in [b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8', b'9']
+        for block_magic in [b'1AY&SY', b'\x17rE8P\x90']
+    },
+    b'\xfd7zXZ\x00': 'xz',
+}
+
+
+compression_openers = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+
+def infer_compression(file_path, mode='r'):
+    # By the extension of file_path, or by the magic number of an existing file if it is read.
+    file_extension = os.path.splitext(file_path)[1].lower()
+    if file_extension in compression_extensions:
+        return compression_extensions[file_extension]
+
+    if 'r' in mode and os.path.isfile(file_path):
+        with open(file_path, 'rb') as file_object:
+            file_head = file_object.read(max(len(magic_number) for magic_number in compression_magic_numbers))
+        for magic_number, compression in compression_magic_numbers.items():
+            if file_head.startswith(magic_number):
+                return compression
+
+    return None
+
+
+def open_file(file_path, mode='r', file_encoding='utf-8', newline=None, compression='infer', compress_level=None, buffer_size=16*1024*1024):
+    # Open plain or compressed (gzip, bz2, xz) files with the same interface as open().
+    # compression: 'infer' - see infer_compression; None - plain file; 'gzip', 'bz2' or 'xz'.
+    # compress_level: compresslevel of gzip/bz2 (1-9) or preset of xz (0-9), only used when writing.
+    assert compression in {'infer', None, 'gzip', 'bz2', 'xz'}, f'Invalid compression: \'{compression}\' (Ops: [\'infer\', None, \'gzip\', \'bz2\', \'xz\'])'
+    if compression == 'infer':
+        compression = infer_compression(file_path, mode)
+
+    binary = 'b' in mode
+    if compression is None:
+        if binary:
+            return open(file_path, mode, buffering=buffer_size)
+        else:
+            return open(file_path, mode, buffering=buffer_size, encoding=file_encoding, newline=newline)
+
+    binary_mode = mode.replace('t', '').replace('b', '') + 'b'
+    compress_arguments = dict()
+    if compress_level is not None and 'r' not in mode:
+        if compression == 'xz':
+            compress_arguments['preset'] = compress_level
+        else:
+            compress_arguments['compresslevel'] = compress_level
+    file_object = compression_openers[compression](file_path, binary_mode, **compress_arguments)
+
+    # Decompressors read in small blocks, large buffers in front of them cut down the number of calls.
+    if 'r' in mode:
+        file_object = io.BufferedReader(file_object, buffer_size)
+    else:
+        file_object = io.BufferedWriter(file_object, buffer_size)
+
+    if binary:
+        return file_object
+    else:
+        return io.TextIOWrapper(file_object, encoding=file_encoding, newline=newline)
+
+
+def dump_data(file_path, data_object, compression='infer', compress_level=None, out_of_band=False):
+    # out_of_band: pickle by protocol 5 and write large contiguous buffers (e.g. NumPy arrays) as raw segments
+    # aligned to 64 bytes in f'{file_path}.buffers', instead of copying them into the pickle stream.
+    if out_of_band:
+        assert compression in {'infer', None} and infer_compression(file_path, 'w') is None, f'Out-of-band buffers can not be compressed: {file_path}'
+        buffer_spans = list()
+        with open(f'{file_path}.buffers', 'wb', buffering=16*1024*1024) as buffers_object:
+            def write_buffer(pickle_buffer):
+                try:
+                    raw_buffer = pickle_buffer.raw()
+                except BufferError:
+                    # Non-contiguous buffers are serialized in-band.
+                    return True
+                buffers_object.write(b'\x00' * (-buffers_object.tell() % 64))
+                buffer_spans.append((buffers_object.tell(), raw_buffer.nbytes))
+                buffers_object.write(raw_buffer)
+                return False
+
+            payload = pickle.dumps(data_object, protocol=5, buffer_callback=write_buffer)
+
+        with open(file_path, 'wb') as file_object:
+            pickle.dump(dict(buffer_spans=buffer_spans, payload=payload), file_object, protocol=5)
+    else:
+        with open_file(file_path, 'wb', compression=compression, compress_level=compress_level) as file_object:
+            pickle.dump(data_object, file_object)
 
 
-def dump_datas(file_path, data_objects):
-    with open(file_path, 'wb') as file_object:
+def load_data(file_path, compression='infer', out_of_band=False):
+    # out_of_band: load data dumped with out_of_band=True, its buffers are read-only views of an mmap of f'{file_path}.buffers',
+    # so loading does not copy them and the pages are shared by all processes that load the same file.
+    if out_of_band:
+        with open(file_path, 'rb') as file_object:
+            out_of_band_data = pickle.load(file_object)
+
+        buffers = list()
+        if len(out_of_band_data['buffer_spans']) != 0:
+            with open(f'{file_path}.buffers', 'rb') as buffers_object:
+                if os.fstat(buffers_object.fileno()).st_size != 0:
+                    buffers_view = memoryview(mmap.mmap(buffers_object.fileno(), 0, access=mmap.ACCESS_READ))
+                else:
+                    buffers_view = memoryview(b'')
+            buffers = [buffers_view[offset:offset+length] for offset, length in out_of_band_data['buffer_spans']]
+
+        return pickle.loads(out_of_band_data['payload'], buffers=buffers)
+    else:
+        with open_file(file_path, 'rb', compression=compression) as file_object:
+            return pickle.load(file_object)
+
+
+def dump_datas(file_path, data_objects, compression='infer', compress_level=None):
+    with open_file(file_path, 'wb', compression=compression, compress_level=compress_level) as file_object:
         for data_object in data_objects:
             pickle.dump(data_object, file_object)
 
 
-def load_datas(file_path):
-    with open(file_path, 'rb') as file_object:
+def load_datas(file_path, compression='infer'):
+    with open_file(file_path, 'rb', compression=compression) as file_object:
         while True:
             try:
                 yield pickle.load(file_object)
             except EOFError:
                 break
 
-def load_lines(file_path, file_encoding='utf-8', newline='\n'):
-    with open(file_path, 'r', encoding=file_encoding, newline=newline) as file_object:
+def load_lines(file_path, file_encoding='utf-8', newline='\n', compression='infer'):
+    with open_file(file_path, 'r', file_encoding=file_encoding, newline=newline, compression=compression) as file_object:
         for line in file_object:
             yield line
 
 
-def load_plain(file_path, file_encoding='utf-8', newline='\n', partition_unit='line', partition_size=1000000):
+def load_plain(file_path, file_encoding='utf-8', newline='\n', partition_unit='line', partition_size=1000000, compression='infer'):
     assert partition_unit in {'byte', 'line'}, f'Invalid unit of partition: \'{partition_unit}\' (Ops: [\'byte\', \'line\'])'
     assert partition_size > 0, f'Invalid size of partition: \'{partition_size}\''
 
     if partition_unit == 'byte':
-        with open(file_path, 'rb') as file_object:
+        with open_file(file_path, 'rb', compression=compression) as file_object:
             while True:
                 file_partition = file_object.readlines(partition_size)
                 if len(file_partition) == 0:
@@ -83,7 +215,7 @@ def load_plain(file_path, file_encoding='utf-8', newline='\n', partition_unit='l
                     yield file_partition
 
     elif partition_unit == 'line':
-        with open(file_path, 'r', encoding=file_encoding, newline=newline) as file_object:
+        with open_file(file_path, 'r', file_encoding=file_encoding, newline=newline, compression=compression) as file_object:
             while True:
                 file_partition = list(itertools.islice(file_object, partition_size))
                 if len(file_partition) == 0:
@@ -100,3 +232,712 @@ def load_plain(file_path, file_encoding='utf-8', newline='\n', partition_unit='l
             #         file_partition = list()
             # if len(file_partition) != 0:
             #     yield file_partition
+
+
+def split_plain(file_path, partition_number):
+    # Split a file into at most partition_number byte ranges [start, end) whose boundaries are snapped to line starts.
+    # Only (file_path, start, end) needs to be sent to a worker, which then reads and decodes its own range by load_range_lines.
+    assert partition_number > 0, f'Invalid number of partition: \'{partition_number}\''
+    assert infer_compression(file_path) is None, f'Compressed file can not be split by byte ranges: {file_path}'
+    file_size = os.path.getsize(file_path)
+
+    boundaries = [0]
+    with open(file_path, 'rb') as file_object:
+        for partition_index in range(1, partition_number):
+            position = file_size * partition_index // partition_number
+            if position <= boundaries[-1]:
+                continue
+            # The line containing byte (position - 1) is skipped, so the boundary is the first line start >= position.
+            file_object.seek(position - 1)
+            file_object.readline()
+            boundary = file_object.tell()
+            if boundaries[-1] < boundary < file_size:
+                boundaries.append(boundary)
+    boundaries.append(file_size)
+
+    return [(file_path, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+
+def load_range_lines(file_path, start, end, file_encoding='utf-8'):
+    # Lines are split by b'\n' (like newline='\n' in load_lines), so the encoding must be ASCII compatible (e.g. utf-8, GBK).
+    with open(file_path, 'rb', buffering=16*1024*1024) as file_object:
+        file_object.seek(start)
+        position = start
+        for line in file_object:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode(file_encoding)
+
+
+class LineIndex(object):
+    # Byte offsets of all lines of a plain text file, built by one pass over the file and cached next to it.
+    # Lines are served from an mmap of the file, so len(), line_index[i] and line_index[i:j] do not reread the file.
+    # The cache (f'{file_path}.lidx') stores [file size, modification time, offsets...] and is rebuilt if the file changed.
+    def __init__(self, file_path, file_encoding='utf-8', cache_path=None, use_cache=True):
+        self.file_path = file_path
+        self.file_encoding = file_encoding
+        self.cache_path = f'{file_path}.lidx' if cache_path is None else cache_path
+        self.use_cache = use_cache
+        assert infer_compression(file_path) is None, f'Compressed file can not be indexed by byte offsets: {file_path}'
+
+        self.offsets = None
+        if self.use_cache:
+            self.offsets = self.load_offsets()
+        if self.offsets is None:
+            self.offsets = self.build_offsets()
+            if self.use_cache:
+                self.dump_offsets()
+
+        self.file_object = None
+        self.file_mmap = None
+
+    def __getstate__(self):
+        # The mmap is not picklable, it is reopened lazily after unpickling (e.g. in a worker process).
+        state = self.__dict__.copy()
+        state['file_object'] = None
+        state['file_mmap'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[line_index] for line_index in range(start, stop, step)]
+            if start >= stop:
+                return list()
+            # Cut by the indexed offsets, str.splitlines would also split on '\r', '\x0c', '\u2028', etc. inside lines.
+            line_bytes = self.get_bytes(start, stop)
+            base = self.offsets[start]
+            return [
+                line_bytes[line_start-base:line_stop-base].decode(self.file_encoding)
+                for line_start, line_stop in zip(self.offsets[start:stop], self.offsets[start+1:stop+1])
+            ]
+        else:
+            if index < 0:
+                index += len(self)
+            if index < 0 or index >= len(self):
+                raise IndexError(f'Line index out of range: {index}')
+            return self.get_bytes(index, index + 1).decode(self.file_encoding)
+
+    def __iter__(self):
+        for line_index in range(len(self)):
+            yield self[line_index]
+
+    @property
+    def file_status(self):
+        file_stat = os.stat(self.file_path)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def build_offsets(self):
+        # Iterating a binary file splits it by b'\n' in C, and the lengths are accumulated in C as well.
+        offsets = array.array('Q')
+        with open(self.file_path, 'rb', buffering=16*1024*1024) as file_object:
+            offsets.extend(itertools.accumulate(map(len, file_object), initial=0))
+        return offsets
+
+    def load_offsets(self):
+        if not os.path.isfile(self.cache_path):
+            return None
+        cache = array.array('Q')
+        with open(self.cache_path, 'rb') as cache_object:
+            cache.frombytes(cache_object.read())
+        if len(cache) < 3 or tuple(cache[:2]) != self.file_status:
+            return None
+        return cache[2:]
+
+    def dump_offsets(self):
+        cache = array.array('Q', self.file_status)
+        cache.extend(self.offsets)
+        try:
+            with open(self.cache_path, 'wb') as cache_object:
+                cache.tofile(cache_object)
+        except OSError:
+            # The directory of the file may be read-only, the index is still usable without the cache.
+            pass
+
+    def open(self):
+        if self.file_mmap is None:
+            self.file_object = open(self.file_path, 'rb')
+            if self.offsets[-1] != 0:
+                self.file_mmap = mmap.mmap(self.file_object.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files can not be mapped.
+                self.file_mmap = b''
+
+    def close(self):
+        if self.file_object is not None:
+            if isinstance(self.file_mmap, mmap.mmap):
+                self.file_mmap.close()
+            self.file_object.close()
+        self.file_object = None
+        self.file_mmap = None
+
+    def get_bytes(self, start, stop):
+        # Raw bytes of lines [start, stop).
+        self.open()
+        return self.file_mmap[self.offsets[start]:self.offsets[stop]]
+
+
+def dump_records(directory, data_objects, shard_size=100000):
+    # Record store: pickled records in shards ('shard-00000.pkl', ...) plus an index ('index.pkl') of their byte offsets.
+    # Unlike dump_datas, the store can be read by RecordStore with len(), random access and per-worker ranges.
+    assert shard_size > 0, f'Invalid size of shard: \'{shard_size}\''
+    os.makedirs(directory, exist_ok=True)
+
+    shard_record_numbers = list()
+    offsets = array.array('Q')
+    data_objects = iter(data_objects)
+    while True:
+        shard_objects = list(itertools.islice(data_objects, shard_size))
+        if len(shard_objects) == 0:
+            break
+
+        shard_path = os.path.join(directory, f'shard-{len(shard_record_numbers):05d}.pkl')
+        with open(shard_path, 'wb', buffering=16*1024*1024) as shard_object:
+            offsets.append(0)
+            for data_object in shard_objects:
+                pickle.dump(data_object, shard_object)
+                offsets.append(shard_object.tell())
+        shard_record_numbers.append(len(shard_objects))
+
+    dump_data(os.path.join(directory, 'index.pkl'), dict(shard_record_numbers=shard_record_numbers, offsets=offsets), compression=None)
+
+
+class RecordStore(object):
+    # Read a record store dumped by dump_records. Records are unpickled from mmaps of the shards,
+    # so store[k] and store[i:j] only touch the bytes of those records.
+    # Workers can read disjoint parts by store.iterate(*store.split(partition_number)[worker_index]).
+    def __init__(self, directory):
+        self.directory = directory
+        index = load_data(os.path.join(directory, 'index.pkl'), compression=None)
+        self.shard_record_numbers = index['shard_record_numbers']
+        self.offsets = index['offsets']
+
+        # Shard k holds records [shard_starts[k], shard_starts[k+1]), its offsets start at offsets[shard_starts[k] + k].
+        self.shard_starts = list(itertools.accumulate(self.shard_record_numbers, initial=0))
+
+        self.shard_objects = dict()
+        self.shard_mmaps = dict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shard_objects'] = dict()
+        state['shard_mmaps'] = dict()
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.shard_starts[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[record_index] for record_index in range(start, stop, step)]
+            return list(self.iterate(start, stop))
+        else:
+            if index < 0:
+                index += len(self)
+            if index < 0 or index >= len(self):
+                raise IndexError(f'Record index out of range: {index}')
+            shard_index = bisect.bisect_right(self.shard_starts, index) - 1
+            offset_index = index + shard_index
+            shard_mmap = self.get_shard_mmap(shard_index)
+            return pickle.loads(shard_mmap[self.offsets[offset_index]:self.offsets[offset_index+1]])
+
+    def __iter__(self):
+        return self.iterate()
+
+    def get_shard_mmap(self, shard_index):
+        if shard_index not in self.shard_mmaps:
+            shard_path = os.path.join(self.directory, f'shard-{shard_index:05d}.pkl')
+            shard_object = open(shard_path, 'rb')
+            self.shard_objects[shard_index] = shard_object
+            self.shard_mmaps[shard_index] = mmap.mmap(shard_object.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shard_mmaps[shard_index]
+
+    def close(self):
+        for shard_mmap in self.shard_mmaps.values():
+            shard_mmap.close()
+        for shard_object in self.shard_objects.values():
+            shard_object.close()
+        self.shard_objects = dict()
+        self.shard_mmaps = dict()
+
+    def iterate(self, start=0, stop=None):
+        # Yield records [start, stop) in order, reading each shard sequentially.
+        if stop is None:
+            stop = len(self)
+        start, stop = max(start, 0), min(stop, len(self))
+        for shard_index in range(len(self.shard_record_numbers)):
+            shard_start, shard_stop = self.shard_starts[shard_index], self.shard_starts[shard_index + 1]
+            if shard_stop <= start or stop <= shard_start:
+                continue
+            shard_mmap = self.get_shard_mmap(shard_index)
+            for record_index in range(max(start, shard_start), min(stop, shard_stop)):
+                offset_index = record_index + shard_index
+                yield pickle.loads(shard_mmap[self.offsets[offset_index]:self.offsets[offset_index+1]])
+
+    def split(self, partition_number):
+        # Split records into partition_number contiguous ranges [start, stop) of nearly equal sizes.
+        assert partition_number > 0, f'Invalid number of partition: \'{partition_number}\''
+        quotient, remainder = divmod(len(self), partition_number)
+        boundaries = list(itertools.accumulate((quotient + (partition_index < remainder) for partition_index in range(partition_number)), initial=0))
+        return [(start, stop) for start, stop in zip(boundaries[:-1], boundaries[1:])]
+
+
+class Prefetcher(object):
+    # Read the next prefetch_size items of an iterator (e.g. partitions of load_plain) in a background thread.
+    # Exceptions raised by the iterator are re-raised by the consumer, and close() (or leaving the with-block) stops the thread.
+    # waiting_time is how long the consumer has been blocked on the queue: if it stays near 0, I/O is no longer the bottleneck.
+    def __init__(self, iterator, prefetch_size=2):
+        assert prefetch_size > 0, f'Invalid size of prefetch: \'{prefetch_size}\''
+        self.iterator = iter(iterator)
+        self.item_queue = queue.Queue(maxsize=prefetch_size)
+        self.stop_event = threading.Event()
+        self.finished = False
+
+        self.waiting_timer = Timer()
+        self.waiting_timer.launch()
+        self.waiting_timer.standby()
+
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+
+        self.waiting_timer.restart()
+        item_type, item = self.item_queue.get()
+        self.waiting_timer.standby()
+
+        if item_type == 'item':
+            return item
+
+        self.finished = True
+        self.thread.join()
+        if item_type == 'error':
+            raise item
+        raise StopIteration
+
+    @property
+    def waiting_time(self):
+        return self.waiting_timer.elapsed_time
+
+    def put(self, item_type, item):
+        while not self.stop_event.is_set():
+            try:
+                self.item_queue.put((item_type, item), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(self):
+        try:
+            for item in self.iterator:
+                if not self.put('item', item):
+                    break
+            else:
+                self.put('end', None)
+        except BaseException as exception:
+            self.put('error', exception)
+        finally:
+            # Generators (e.g. load_plain) are closed in this thread, so that their files are closed as well.
+            if hasattr(self.iterator, 'close'):
+                self.iterator.close()
+
+    def close(self):
+        self.stop_event.set()
+        self.finished = True
+        while True:
+            try:
+                self.item_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join()
+
+
+def fsync_directory(directory):
+    # Directories can not be opened on Windows, where renames are not fsynced this way.
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    directory_descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory_descriptor)
+    finally:
+        os.close(directory_descriptor)
+
+
+class LineWriter(object):
+    # Buffered line writer, the counterpart of load_lines. Lines are written as given (with their newlines).
+    #   Buffering: lines are encoded and joined into one write of about buffer_size bytes.
+    #   Sharding: if shard_lines or shard_bytes (uncompressed) is set, output goes to shards 'name-00000.txt', 'name-00001.txt', ...
+    #   Atomicity: each shard is written to a temp file in the same directory and renamed when it is complete,
+    #              a shard that is aborted by an exception is removed, so readers never see partial files.
+    #   fsync_policy: 'never'; 'close' - fsync each shard before its rename, and its directory after; 'always' - also fsync after each buffer write.
+    def __init__(self, file_path, file_encoding='utf-8', buffer_size=16*1024*1024, shard_lines=None, shard_bytes=None, fsync_policy='close', compression='infer', compress_level=None):
+        assert fsync_policy in {'never', 'close', 'always'}, f'Invalid fsync policy: \'{fsync_policy}\' (Ops: [\'never\', \'close\', \'always\'])'
+        assert compression in {'infer', None, 'gzip', 'bz2', 'xz'}, f'Invalid compression: \'{compression}\' (Ops: [\'infer\', None, \'gzip\', \'bz2\', \'xz\'])'
+        assert shard_lines is None or shard_lines > 0, f'Invalid number of lines per shard: \'{shard_lines}\''
+        assert shard_bytes is None or shard_bytes > 0, f'Invalid number of bytes per shard: \'{shard_bytes}\''
+        self.file_path = file_path
+        self.file_encoding = file_encoding
+        self.buffer_size = buffer_size
+        self.shard_lines = shard_lines
+        self.shard_bytes = shard_bytes
+        self.fsync_policy = fsync_policy
+        self.compression = infer_compression(file_path, 'w') if compression == 'infer' else compression
+        self.compress_level = compress_level
+
+        self.shard_paths = list()
+        self.buffer = list()
+        self.buffer_bytes = 0
+        self.raw_object = None
+        self.file_object = None
+        self.temp_path = None
+        self.current_lines = 0
+        self.current_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def sharded(self):
+        return self.shard_lines is not None or self.shard_bytes is not None
+
+    def get_shard_path(self, shard_index):
+        if not self.sharded:
+            return self.file_path
+        directory, file_name = os.path.split(self.file_path)
+        compression_extension = ''
+        for extension, compression in compression_extensions.items():
+            if file_name.lower().endswith(extension):
+                file_name, compression_extension = file_name[:-len(extension)], file_name[-len(extension):]
+                break
+        file_stem, file_extension = os.path.splitext(file_name)
+        return os.path.join(directory, f'{file_stem}-{shard_index:05d}{file_extension}{compression_extension}')
+
+    def open_shard(self):
+        shard_path = self.get_shard_path(len(self.shard_paths))
+        directory = os.path.dirname(os.path.abspath(shard_path))
+        # mkstemp rather than mk_temp, whose descriptor is discarded and would leak one per shard, the file is written through it.
+        temp_descriptor, self.temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(shard_path)}.')
+        # mkstemp creates files only readable by the owner, the final file gets the usual permissions.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.temp_path, 0o666 & ~umask)
+
+        # Compressors are stacked on the raw file (not opened by path), so that the raw file can be fsynced.
+        self.raw_object = os.fdopen(temp_descriptor, 'wb')
+        if self.compression is None:
+            self.file_object = self.raw_object
+        elif self.compression == 'gzip':
+            compress_level = 9 if self.compress_level is None else self.compress_level
+            self.file_object = gzip.GzipFile(filename='', mode='wb', compresslevel=compress_level, fileobj=self.raw_object)
+        elif self.compression == 'bz2':
+            compress_level = 9 if self.compress_level is None else self.compress_level
+            self.file_object = bz2.BZ2File(self.raw_object, mode='wb', compresslevel=compress_level)
+        elif self.compression == 'xz':
+            self.file_object = lzma.LZMAFile(self.raw_object, mode='wb', preset=self.compress_level)
+        self.shard_paths.append(shard_path)
+        self.current_lines = 0
+        self.current_bytes = 0
+
+    def close_shard(self):
+        self.flush()
+        if self.file_object is not self.raw_object:
+            self.file_object.close()
+        self.raw_object.flush()
+        if self.fsync_policy != 'never':
+            os.fsync(self.raw_object.fileno())
+        self.raw_object.close()
+        os.replace(self.temp_path, self.shard_paths[-1])
+        if self.fsync_policy != 'never':
+            # The rename itself is only durable once the directory entry is flushed.
+            fsync_directory(os.path.dirname(os.path.abspath(self.shard_paths[-1])))
+        self.raw_object = None
+        self.file_object = None
+        self.temp_path = None
+
+    def flush(self):
+        if len(self.buffer) != 0:
+            self.file_object.write(b''.join(self.buffer))
+            self.buffer = list()
+            self.buffer_bytes = 0
+            if self.fsync_policy == 'always':
+                self.file_object.flush()
+                self.raw_object.flush()
+                os.fsync(self.raw_object.fileno())
+
+    def write(self, line):
+        if self.file_object is None:
+            self.open_shard()
+        elif (self.shard_lines is not None and self.current_lines >= self.shard_lines) or (self.shard_bytes is not None and self.current_bytes >= self.shard_bytes):
+            self.close_shard()
+            self.open_shard()
+
+        line = line.encode(self.file_encoding)
+        self.buffer.append(line)
+        self.buffer_bytes += len(line)
+        self.current_lines += 1
+        self.current_bytes += len(line)
+        if self.buffer_bytes >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        # An empty output still produces one (empty) file.
+        if self.file_object is None and len(self.shard_paths) == 0:
+            self.open_shard()
+        if self.file_object is not None:
+            self.close_shard()
+
+    def abort(self):
+        if self.file_object is not None:
+            if self.file_object is not self.raw_object:
+                self.file_object.close()
+            self.raw_object.close()
+            os.remove(self.temp_path)
+            self.shard_paths.pop()
+        self.buffer = list()
+        self.buffer_bytes = 0
+        self.raw_object = None
+        self.file_object = None
+        self.temp_path = None
+
+
+def dump_lines(file_path, lines, file_encoding='utf-8', buffer_size=16*1024*1024, shard_lines=None, shard_bytes=None, fsync_policy='close', compression='infer', compress_level=None):
+    # Write lines by a LineWriter (see it for the arguments), and return the paths of the written files.
+    with LineWriter(
+        file_path, file_encoding=file_encoding, buffer_size=buffer_size,
+        shard_lines=shard_lines, shard_bytes=shard_bytes, fsync_policy=fsync_policy,
+        compression=compression, compress_level=compress_level
+    ) as line_writer:
+        line_writer.writelines(lines)
+    return line_writer.shard_paths
+
+
+def shuffle_stream(items, buffer_size=100000, seed=None):
+    # Approximately shuffle an iterator of any length with a bounded buffer:
+    # once the buffer is full, each incoming item replaces (and yields) a random buffered one.
+    assert buffer_size > 0, f'Invalid size of buffer: \'{buffer_size}\''
+    random_generator = random.Random(seed)
+    buffer = list()
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+        else:
+            buffer_index = random_generator.randrange(buffer_size)
+            yield buffer[buffer_index]
+            buffer[buffer_index] = item
+
+    random_generator.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
+def shuffle_shards(file_path, shard_size=100000, seed=None, shuffle_within_shard=True, file_encoding='utf-8'):
+    # Shuffle a whole file with memory bounded by shard_size lines: the order of the shards (of consecutive lines)
+    # is shuffled by the LineIndex of the file, then each shard is read at once and shuffled within.
+    assert shard_size > 0, f'Invalid size of shard: \'{shard_size}\''
+    random_generator = random.Random(seed)
+    with LineIndex(file_path, file_encoding=file_encoding) as line_index:
+        shard_starts = list(range(0, len(line_index), shard_size))
+        random_generator.shuffle(shard_starts)
+        for shard_start in shard_starts:
+            shard_lines = line_index[shard_start:shard_start+shard_size]
+            if shuffle_within_shard:
+                random_generator.shuffle(shard_lines)
+            for line in shard_lines:
+                yield line
+
+
+def bucket_lines(lines, token_budget, bucket_width=8, length_function=None):
+    # Group lines of similar lengths into batches, whose padded size (max length * number of lines) is at most token_budget.
+    # Lines of lengths [k * bucket_width, (k + 1) * bucket_width) share bucket k, and each bucket buffers at most one batch,
+    # so memory is bounded by about token_budget tokens per bucket. A line longer than token_budget forms a batch alone.
+    # length_function: the length of a line (default: number of whitespace-separated tokens).
+    assert token_budget > 0, f'Invalid budget of token: \'{token_budget}\''
+    assert bucket_width > 0, f'Invalid width of bucket: \'{bucket_width}\''
+    if length_function is None:
+        length_function = lambda line: len(line.split())
+
+    buckets = dict()
+    for line in lines:
+        line_length = length_function(line)
+        bucket_index = line_length // bucket_width
+        # Empty lines still take memory, they count as 1 token so that their batches are bounded as well.
+        line_cost = max(line_length, 1)
+        batch, max_length = buckets.get(bucket_index, (list(), 0))
+        if len(batch) != 0 and (len(batch) + 1) * max(max_length, line_cost) > token_budget:
+            yield batch
+            batch, max_length = list(), 0
+        batch.append(line)
+        buckets[bucket_index] = (batch, max(max_length, line_cost))
+
+    for bucket_index in sorted(buckets):
+        batch, _ = buckets[bucket_index]
+        if len(batch) != 0:
+            yield batch
+
+
+class Deduplicator(object):
+    # Drop repeated lines of a stream (e.g. load_lines, or partitions of load_plain), keeping the first occurrence.
+    # Lines are hashed into 64-bit fingerprints (optionally after normalize_function, e.g. yoolkit.text.normalize).
+    # New fingerprints go to a small set of recent ones, which is sorted into a compact array('Q') run in memory (8 bytes per
+    # fingerprint) whenever it is full. Once memory runs hold about memory_budget bytes, they are merged and spilled to a run file
+    # under a temp dir (mk_temp); runs are binary searched (through mmaps on disk) and merged when there are more than max_run_number.
+    # Note: distinct lines with the same 64-bit fingerprint are dropped as duplicates, which is very unlikely below billions of lines.
+    def __init__(self, memory_budget=256*1024*1024, normalize_function=None, max_run_number=8, temp_location=tempfile.gettempdir()):
+        assert memory_budget > 0, f'Invalid budget of memory: \'{memory_budget}\''
+        assert max_run_number > 1, f'Invalid number of run: \'{max_run_number}\''
+        # A fingerprint takes 8 bytes in a memory run, and about 64 bytes (int object and hash table slot) while it is recent.
+        # The recent set holds 1/16 of the fingerprints in memory, so they take about 12 bytes each on average.
+        self.memory_capacity = max(memory_budget // 12, 16)
+        self.recent_capacity = self.memory_capacity // 16
+        self.normalize_function = normalize_function
+        self.max_run_number = max_run_number
+        self.temp_location = temp_location
+
+        self.recent_fingerprints = set()
+        self.memory_runs = list()
+        self.memory_number = 0
+        self.runs = list()
+        self.temp_dir = None
+
+        self.kept_number = 0
+        self.dropped_number = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fingerprint(self, line):
+        # Lines are str, or bytes for partitions of load_plain(..., partition_unit='byte'), which are hashed as they are.
+        if isinstance(line, str):
+            if self.normalize_function is not None:
+                line = self.normalize_function(line)
+            line = line.encode('utf-8')
+        return int.from_bytes(hashlib.blake2b(line, digest_size=8).digest(), 'little')
+
+    def contains(self, fingerprint):
+        if fingerprint in self.recent_fingerprints:
+            return True
+        for memory_run in self.memory_runs:
+            run_index = bisect.bisect_left(memory_run, fingerprint)
+            if run_index < len(memory_run) and memory_run[run_index] == fingerprint:
+                return True
+        for _, _, run_view in self.runs:
+            run_index = bisect.bisect_left(run_view, fingerprint)
+            if run_index < len(run_view) and run_view[run_index] == fingerprint:
+                return True
+        return False
+
+    def open_run(self, run_path):
+        run_object = open(run_path, 'rb')
+        run_mmap = mmap.mmap(run_object.fileno(), 0, access=mmap.ACCESS_READ)
+        run_object.close()
+        return run_path, run_mmap, memoryview(run_mmap).cast('Q')
+
+    def close_run(self, run):
+        run_path, run_mmap, run_view = run
+        run_view.release()
+        run_mmap.close()
+        os.remove(run_path)
+
+    def write_run(self, sorted_fingerprints):
+        # mkstemp rather than mk_temp, whose descriptor is discarded and would leak one per run, the run is written through it.
+        if self.temp_dir is None:
+            self.temp_dir = mk_temp('yoolkit-dedup-', 'dir', location=self.temp_location)
+        run_descriptor, run_path = tempfile.mkstemp(dir=self.temp_dir, prefix='run-')
+        with os.fdopen(run_descriptor, 'wb', buffering=16*1024*1024) as run_object:
+            while True:
+                fingerprint_block = array.array('Q', itertools.islice(sorted_fingerprints, 1024*1024))
+                if len(fingerprint_block) == 0:
+                    break
+                fingerprint_block.tofile(run_object)
+        return self.open_run(run_path)
+
+    def flush_recent(self):
+        if len(self.recent_fingerprints) != 0:
+            self.memory_runs.append(array.array('Q', sorted(self.recent_fingerprints)))
+            self.recent_fingerprints = set()
+
+    def spill(self):
+        self.flush_recent()
+        self.runs.append(self.write_run(heapq.merge(*self.memory_runs)))
+        self.memory_runs = list()
+        self.memory_number = 0
+
+        if len(self.runs) > self.max_run_number:
+            merged_run = self.write_run(heapq.merge(*[run_view for _, _, run_view in self.runs]))
+            for run in self.runs:
+                self.close_run(run)
+            self.runs = [merged_run]
+
+    def deduplicate(self, lines):
+        for line in lines:
+            fingerprint = self.fingerprint(line)
+            if self.contains(fingerprint):
+                self.dropped_number += 1
+                continue
+            self.recent_fingerprints.add(fingerprint)
+            self.memory_number += 1
+            if self.memory_number >= self.memory_capacity:
+                self.spill()
+            elif len(self.recent_fingerprints) >= self.recent_capacity:
+                self.flush_recent()
+            self.kept_number += 1
+            yield line
+
+    def deduplicate_partitions(self, partitions):
+        for partition in partitions:
+            yield list(self.deduplicate(partition))
+
+    def close(self):
+        for run in self.runs:
+            self.close_run(run)
+        self.runs = list()
+        self.recent_fingerprints = set()
+        self.memory_runs = list()
+        self.memory_number = 0
+        if self.temp_dir is not None:
+            rm_temp(self.temp_dir)
+            self.temp_dir = None
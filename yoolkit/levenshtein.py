@@ -10,11 +10,17 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import heapq
 import numpy
 import random
+import functools
+import itertools
+import collections
 
 
 from yoolkit.constant import Constant
+from yoolkit.statistics import Statistics
+from yoolkit.multiprocessing import multi_process_imap
 
 
 constant = Constant()
@@ -25,6 +31,14 @@ constant.INSERTION = '<INS>'
 constant.SUBSTITUTION = '<SUB>'
 
 
+candidate_flags = {
+    constant.MATCHING : 1,
+    constant.SUBSTITUTION : 2,
+    constant.DELETION : 4,
+    constant.INSERTION : 8
+}
+
+
 """LevenshteinTool can Calculating Levenshtein-Distance, Printing Manipulation-Sequence, Aligned-Sequences and so on
 
 Levenshtein-Distance(L-Distance, LD) is a measure of the similarity between two sequences, which we will refer to as the reference sequence (ref) and the hypothesis sequence (hyp).
@@ -58,93 +72,273 @@ Note:
 """
 
 
+def tokenize(sequence, level):
+    assert level in {None, 'word', 'char'}, f'Invalid level of tokenization: \'{level}\' (Ops: [None, \'word\', \'char\'])'
+    if level == 'word' and isinstance(sequence, str):
+        return sequence.split()
+    if level == 'char' and isinstance(sequence, str):
+        return list(sequence)
+    return sequence
+
+
+def chunk_pairs(sources, targets, chunk_size):
+    pairs = zip(sources, targets)
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_size))
+        if len(chunk) == 0:
+            break
+        else:
+            yield chunk
+
+
+def calculate_chunk_distances(chunk, levenshtein, level, max_distance):
+    distances = numpy.zeros(len(chunk), dtype=numpy.float64)
+    total_source_length = 0
+    total_target_length = 0
+    for pair_index, (source, target) in enumerate(chunk):
+        source, target = tokenize(source, level), tokenize(target, level)
+        distances[pair_index] = levenshtein.get_levenshtein_distance(source, target, max_distance=max_distance)
+        total_source_length += len(source)
+        total_target_length += len(target)
+    return distances, total_source_length, total_target_length
+
+
+def process_chunks(method, chunks, method_arguments, number_worker):
+    # Yield method(chunk, **method_arguments) in the order of chunks, each chunk is one task of multi_process_imap.
+    method = functools.partial(method, **method_arguments)
+    if number_worker == 1:
+        for chunk in chunks:
+            yield method(chunk)
+    else:
+        yield from multi_process_imap(method, chunks, number_worker, chunksize=1)
+
+
+def calculate_chunk_manipulation_statistics(chunk, levenshtein, level, confusion_size):
+    manipulation_statistics = ManipulationStatistics(confusion_size=confusion_size)
+    for source, target in chunk:
+        levenshtein.accumulate_manipulation_statistics(tokenize(source, level), tokenize(target, level), manipulation_statistics)
+    manipulation_statistics.trim()
+    return manipulation_statistics
+
+
+class ManipulationStatistics(Statistics):
+    # Counts of <MAT>/<SUB>/<INS>/<DEL> and a confusion table of substitutions ((source element, target element) -> count).
+    # Instances are merged by '+', so partial statistics of worker processes can be summed up.
+    # If confusion_size is set, only the confusion_size most common substitutions are kept after each merge (approximate top-K).
+    def __init__(self, confusion_size=None):
+        super(ManipulationStatistics, self).__init__(set(candidate_flags))
+        self.confusion_size = confusion_size
+        self.confusions = collections.Counter()
+
+    def __add__(self, other):
+        result_statistics = ManipulationStatistics(confusion_size=self.confusion_size)
+        for attribute_name in result_statistics.structure:
+            result_statistics[attribute_name] = self[attribute_name] + other[attribute_name]
+        result_statistics.confusions = self.confusions + other.confusions
+        result_statistics.trim()
+        return result_statistics
+
+    def __radd__(self, other):
+        # Support sum() of a list of ManipulationStatistics.
+        if other == 0:
+            return self
+        return self + other
+
+    def trim(self):
+        if self.confusion_size is not None and len(self.confusions) > self.confusion_size:
+            self.confusions = collections.Counter(dict(self.confusions.most_common(self.confusion_size)))
+
+    def top_confusions(self, k):
+        return self.confusions.most_common(k)
+
+
+class Vocabulary(object):
+    # Interns elements to int32 ids. One vocabulary is meant to be shared by all pairs of a corpus,
+    # so that each element is hashed once and the DP runs on contiguous integer arrays.
+    def __init__(self, elements=None):
+        self.element_to_id = dict()
+        self.id_to_element = list()
+        if elements is not None:
+            for element in elements:
+                self.add(element)
+
+    def __len__(self):
+        return len(self.id_to_element)
+
+    def __contains__(self, element):
+        return element in self.element_to_id
+
+    def __getitem__(self, element):
+        return self.element_to_id[element]
+
+    def add(self, element):
+        element_id = self.element_to_id.get(element)
+        if element_id is None:
+            element_id = len(self.id_to_element)
+            self.element_to_id[element] = element_id
+            self.id_to_element.append(element)
+        return element_id
+
+    def encode(self, sequence):
+        return numpy.fromiter((self.add(element) for element in sequence), dtype=numpy.int32, count=len(sequence))
+
+    def decode(self, sequence_ids):
+        return [self.id_to_element[element_id] for element_id in numpy.asarray(sequence_ids).tolist()]
+
+
+def is_encoded(sequence):
+    return isinstance(sequence, numpy.ndarray) and numpy.issubdtype(sequence.dtype, numpy.integer)
+
+
 class Levenshtein(object):
     def __init__(self,
         deletion_weight=1, insertion_weight=1, substitution_weight=1,
-        mat_prob=0.25, del_prob=0.25, ins_prob=0.25, sub_prob=0.25
+        mat_prob=0.25, del_prob=0.25, ins_prob=0.25, sub_prob=0.25,
+        linear_memory_threshold=10000000,
+        tie_break_policy='random', random_seed=None,
+        vocabulary=None, stage_dtype=None
     ):
+        assert tie_break_policy in {'random', 'first'}, f'Invalid tie break policy: \'{tie_break_policy}\' (Ops: [\'random\', \'first\'])'
+
         self.deletion_weight = deletion_weight
         self.insertion_weight = insertion_weight
         self.substitution_weight = substitution_weight
+        # Alignments of (source, target) pairs whose stage matrix has more cells than this threshold are computed in linear memory.
+        self.linear_memory_threshold = linear_memory_threshold
         self.manipulation_choice_probabilities = {
             constant.MATCHING : mat_prob,
             constant.DELETION : del_prob,
             constant.INSERTION : ins_prob,
             constant.SUBSTITUTION : sub_prob
         }
+        self.tie_break_policy = tie_break_policy
+        self.random_generator = numpy.random.default_rng(random_seed)
+        # Sources and targets can also be given as int arrays encoded by this vocabulary (see Vocabulary.encode).
+        self.vocabulary = vocabulary
+        # Force the dtype of stage matrices, otherwise it is chosen by get_stage_dtype.
+        self.stage_dtype = None if stage_dtype is None else numpy.dtype(stage_dtype)
 
     def calculate_stage_matrix(self, source, target):
         stage_matrix_size = (len(source) + 1, len(target) + 1)
-        stage_matrix = numpy.zeros(stage_matrix_size, dtype=numpy.uint)
-
-        stage_matrix[:,0] = numpy.arange(stage_matrix_size[0])
-        stage_matrix[0,:] = numpy.arange(stage_matrix_size[1])
-
-        for source_stage_index in range(1, stage_matrix_size[0]):
-            for target_stage_index in range(1, stage_matrix_size[1]):
-                source_index = source_stage_index - 1
-                target_index = target_stage_index - 1
-                if source[source_index] == target[target_index]:
-                    #Matching
-                    stage_matrix[source_stage_index, target_stage_index] = stage_matrix[source_stage_index-1, target_stage_index-1]
-                else:
-                    deletion = stage_matrix[source_stage_index-1, target_stage_index] #Deletion
-                    insertion = stage_matrix[source_stage_index, target_stage_index-1] #Insertion
-                    substitution = stage_matrix[source_stage_index-1, target_stage_index-1] #Substitution
-                    stage_matrix[source_stage_index, target_stage_index] = min(
-                        deletion + self.deletion_weight,
-                        insertion + self.insertion_weight,
-                        substitution + self.substitution_weight
-                    )
+        stage_matrix = numpy.zeros(stage_matrix_size, dtype=self.get_stage_dtype(len(source), len(target)))
+
+        stage_matrix[:,0] = self.calculate_boundary(len(source), self.deletion_weight, stage_matrix.dtype)
+        stage_matrix[0,:] = self.calculate_boundary(len(target), self.insertion_weight, stage_matrix.dtype)
+
+        # Cells on one anti-diagonal are independent of each other, so they are filled at once.
+        equality_matrix = self.calculate_equality_matrix(source, target)
+        for diagonal_index in range(2, len(source) + len(target) + 1):
+            source_stage_indices = numpy.arange(max(1, diagonal_index - len(target)), min(len(source), diagonal_index - 1) + 1)
+            target_stage_indices = diagonal_index - source_stage_indices
+            matching = stage_matrix[source_stage_indices-1, target_stage_indices-1]
+            deletion = stage_matrix[source_stage_indices-1, target_stage_indices] + self.deletion_weight
+            insertion = stage_matrix[source_stage_indices, target_stage_indices-1] + self.insertion_weight
+            substitution = matching + self.substitution_weight
+            stage_matrix[source_stage_indices, target_stage_indices] = numpy.where(
+                equality_matrix[source_stage_indices-1, target_stage_indices-1],
+                matching,
+                numpy.minimum(numpy.minimum(deletion, insertion), substitution)
+            )
 
         return stage_matrix
 
-    def backtrack_manipulation_sequence(self, source, target, stage_matrix):
-        manipulation_sequence = []
+    def calculate_boundary(self, length, weight, dtype):
+        # [0, w, w + w, ...] accumulated by addition rather than index * w, so that each cell equals its neighbour + w exactly,
+        # also for float weights (e.g. 0.5 + 0.1 != 6 * 0.1), as calculate_candidate_matrix expects.
+        boundary = numpy.zeros(length + 1, dtype=dtype)
+        boundary[1:] = numpy.full(length, weight, dtype=dtype).cumsum(dtype=dtype)
+        return boundary
+
+    def calculate_equality_matrix(self, source, target):
+        try:
+            source_ids, target_ids = self.encode_source_and_target(source, target)
+            equality_matrix = source_ids[:, None] == target_ids[None, :]
+        except TypeError:
+            equality_matrix = numpy.array([[source_element == target_element for target_element in target] for source_element in source], dtype=bool)
+            equality_matrix = equality_matrix.reshape((len(source), len(target)))
+        return equality_matrix
+
+    def calculate_candidate_matrix(self, source, target, stage_matrix):
+        # Bit flags of all manipulations that lead to each cell of the stage matrix by an optimal path, computed at once.
+        candidate_matrix = numpy.zeros(stage_matrix.shape, dtype=numpy.uint8)
+
+        equality_matrix = self.calculate_equality_matrix(source, target)
+        diagonal_equal = stage_matrix[1:, 1:] == stage_matrix[:-1, :-1]
+        diagonal_substitution = stage_matrix[1:, 1:] == stage_matrix[:-1, :-1] + self.substitution_weight
+        # Matching and substitution are told apart by the elements, not by the cost: with substitution_weight=0 they cost the same.
+        candidate_matrix[1:, 1:] |= (diagonal_equal & equality_matrix).astype(numpy.uint8) * candidate_flags[constant.MATCHING]
+        candidate_matrix[1:, 1:] |= (diagonal_substitution & ~equality_matrix).astype(numpy.uint8) * candidate_flags[constant.SUBSTITUTION]
+        candidate_matrix[1:, :] |= (stage_matrix[1:, :] == stage_matrix[:-1, :] + self.deletion_weight).astype(numpy.uint8) * candidate_flags[constant.DELETION]
+        candidate_matrix[:, 1:] |= (stage_matrix[:, 1:] == stage_matrix[:, :-1] + self.insertion_weight).astype(numpy.uint8) * candidate_flags[constant.INSERTION]
+
+        return candidate_matrix
+
+    def build_choice_table(self):
+        # For each combination of candidate flags: the candidate manipulations and their cumulative choice probabilities.
+        choice_table = list()
+        for candidate_code in range(1 << len(candidate_flags)):
+            candidate_actions = [action for action, flag in candidate_flags.items() if candidate_code & flag]
+            choice_probs = numpy.array([self.manipulation_choice_probabilities[action] for action in candidate_actions], dtype=numpy.float64)
+            if len(candidate_actions) != 0 and choice_probs.sum() > 0:
+                choice_probs = choice_probs.cumsum() / choice_probs.sum()
+            else:
+                choice_probs = numpy.linspace(1, len(candidate_actions), len(candidate_actions)) / max(len(candidate_actions), 1)
+            choice_table.append((candidate_actions, choice_probs.tolist()))
+        return choice_table
+
+    def backtrack_manipulation_sequence(self, source, target, stage_matrix, random_generator=None):
+        manipulation_sequence = [action for action, _, _ in self.walk_manipulations(source, target, stage_matrix, random_generator=random_generator)]
+        manipulation_sequence = manipulation_sequence[::-1]
+
+        return manipulation_sequence
+
+    def walk_manipulations(self, source, target, stage_matrix, random_generator=None):
+        # Yield (manipulation, x, y) from the last cell back to the first one, where (x, y) is the cell the manipulation leads to.
+        # Ties between optimal manipulations are broken by tie_break_policy:
+        #     'random' - drawn with the probabilities mat_prob/del_prob/ins_prob/sub_prob from random_generator (default: self.random_generator);
+        #     'first' - the first one in the order <MAT>, <SUB>, <DEL>, <INS>, which is deterministic.
+        if random_generator is None:
+            random_generator = self.random_generator
+
+        candidate_matrix = self.calculate_candidate_matrix(source, target, stage_matrix)
+        choice_table = self.build_choice_table()
+
         x, y = len(source), len(target)
+        if self.tie_break_policy == 'random':
+            random_numbers = random_generator.random(x + y).tolist()
+        else:
+            random_numbers = [0.0] * (x + y)
+
+        step = 0
         while x != 0 or y != 0:
-            candidate_actions = []
-            choice_probs = []
-            if x>0 and y>0:
-                if stage_matrix[x, y] == stage_matrix[x-1, y-1]:
-                    if source[x-1] == target[y-1]:
-                        candidate_actions.append(constant.MATCHING) #Matching
-                        choice_probs.append(self.manipulation_choice_probabilities[constant.MATCHING])
-                elif stage_matrix[x, y] == (stage_matrix[x-1, y-1] + self.substitution_weight):
-                    candidate_actions.append(constant.SUBSTITUTION) #Substitution
-                    choice_probs.append(self.manipulation_choice_probabilities[constant.SUBSTITUTION])
-            if x>0:
-                if stage_matrix[x, y] == (stage_matrix[x-1, y] + self.deletion_weight):
-                    candidate_actions.append(constant.DELETION) #Deletion
-                    choice_probs.append(self.manipulation_choice_probabilities[constant.DELETION])
-            if y>0:
-                if stage_matrix[x, y] == (stage_matrix[x, y-1] + self.insertion_weight):
-                    candidate_actions.append(constant.INSERTION) #INSERTION
-                    choice_probs.append(self.manipulation_choice_probabilities[constant.INSERTION])
-
-            choice_prob_sum = sum(choice_probs)
-            choice_probs = [choice_prob/choice_prob_sum for choice_prob in choice_probs]
-            action_index = numpy.random.choice(len(candidate_actions), 1, choice_probs)[0]
+            candidate_actions, choice_probs = choice_table[candidate_matrix[x, y]]
+            if len(candidate_actions) == 0:
+                raise ValueError(f'No optimal manipulation leads to cell ({x}, {y}), the stage matrix is inconsistent with the weights')
+            random_number = random_numbers[step]
+            action_index = 0
+            while action_index < len(candidate_actions) - 1 and random_number >= choice_probs[action_index]:
+                action_index += 1
             action = candidate_actions[action_index]
 
-            if action == constant.MATCHING:
-                manipulation_sequence.append(constant.MATCHING)
-                x, y = x - 1, y - 1
-            elif action == constant.SUBSTITUTION:
-                manipulation_sequence.append(constant.SUBSTITUTION)
+            yield action, x, y
+            step += 1
+            if action == constant.MATCHING or action == constant.SUBSTITUTION:
                 x, y = x - 1, y - 1
             elif action == constant.DELETION:
-                manipulation_sequence.append(constant.DELETION)
                 x = x - 1
             elif action == constant.INSERTION:
-                manipulation_sequence.append(constant.INSERTION)
                 y = y - 1
 
-        manipulation_sequence = manipulation_sequence[::-1]
-
-        return manipulation_sequence
+    def align_source_and_target(self, source, target, manipulation_sequence, vocabulary=None):
+        # Encoded sources and targets are decoded back to their elements by vocabulary (default: self.vocabulary).
+        if vocabulary is None:
+            vocabulary = self.vocabulary
+        if vocabulary is not None:
+            if is_encoded(source):
+                source = vocabulary.decode(source)
+            if is_encoded(target):
+                target = vocabulary.decode(target)
 
-    def align_source_and_target(self, source, target, manipulation_sequence):
         source_index = 0
         target_index = 0
         aligned_source = []
@@ -167,21 +361,516 @@ class Levenshtein(object):
 
         return aligned_source, aligned_target
 
-    def get_levenshtein_distance(self, source, target):
-        stage_matrix = self.calculate_stage_matrix(source, target)
-        return stage_matrix[-1, -1]
+    @property
+    def integral_weights(self):
+        return all(float(weight).is_integer() for weight in (self.deletion_weight, self.insertion_weight, self.substitution_weight))
+
+    def get_stage_dtype(self, source_length, target_length):
+        # The smallest dtype that holds every cell of the stage matrix (and a cell plus one weight) without overflow:
+        # unsigned ints for non-negative integral weights, signed ints for negative integral weights, float64 otherwise.
+        if self.stage_dtype is not None:
+            return self.stage_dtype
+
+        if not self.integral_weights:
+            return numpy.dtype(numpy.float64)
+
+        weights = (self.deletion_weight, self.insertion_weight, self.substitution_weight)
+        highest = int(source_length * max(self.deletion_weight, 0) + target_length * max(self.insertion_weight, 0) + max(max(weights), 0))
+        lowest = int((source_length + target_length + 1) * min(min(weights), 0))
+        if lowest < 0:
+            candidate_dtypes = (numpy.int8, numpy.int16, numpy.int32, numpy.int64)
+        else:
+            candidate_dtypes = (numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64)
+
+        for candidate_dtype in candidate_dtypes:
+            if numpy.iinfo(candidate_dtype).min <= lowest and highest <= numpy.iinfo(candidate_dtype).max:
+                return numpy.dtype(candidate_dtype)
+        return numpy.dtype(numpy.float64)
+
+    @property
+    def unit_weights(self):
+        return self.deletion_weight == 1 and self.insertion_weight == 1 and self.substitution_weight == 1
+
+    def calculate_distance(self, source, target):
+        # Distance-only engine, the full stage matrix is never allocated.
+        # Unit weights use the bit-parallel algorithm of Myers/Hyyrö, other weights use anti-diagonal sweeping.
+        # Sequences with unhashable elements fall back to the full stage matrix.
+        try:
+            if self.unit_weights:
+                return self.calculate_distance_bit_parallel(source, target)
+            else:
+                return self.calculate_distance_anti_diagonal(source, target)
+        except TypeError:
+            stage_matrix = self.calculate_stage_matrix(source, target)
+            return stage_matrix[-1, -1].item()
+
+    def calculate_distance_bit_parallel(self, source, target, max_distance=None):
+        # Only valid for unit weights, so the distance is symmetric and the shorter sequence can be the pattern.
+        # max_distance: the distance of the last row falls by at most 1 per remaining target element, so max_distance + 1
+        # is returned as soon as it can no longer end within max_distance.
+        if len(source) > len(target):
+            source, target = target, source
+
+        if self.vocabulary is not None and is_encoded(source) != is_encoded(target):
+            source, target = self.encode_source_and_target(source, target)
+        if is_encoded(source):
+            source = source.tolist()
+        if is_encoded(target):
+            target = target.tolist()
+
+        pattern_length = len(source)
+        if pattern_length == 0:
+            return len(target)
+
+        pattern_equalities = dict()
+        for source_index, source_element in enumerate(source):
+            pattern_equalities[source_element] = pattern_equalities.get(source_element, 0) | (1 << source_index)
+
+        mask = (1 << pattern_length) - 1
+        highest_bit = 1 << (pattern_length - 1)
+        vertical_positive = mask
+        vertical_negative = 0
+        distance = pattern_length
+        for target_index, target_element in enumerate(target):
+            equality = pattern_equalities.get(target_element, 0)
+            vertical_x = equality | vertical_negative
+            horizontal_x = (((equality & vertical_positive) + vertical_positive) ^ vertical_positive) | equality
+            horizontal_positive = vertical_negative | (~(horizontal_x | vertical_positive) & mask)
+            horizontal_negative = vertical_positive & horizontal_x
+
+            if horizontal_positive & highest_bit:
+                distance += 1
+            elif horizontal_negative & highest_bit:
+                distance -= 1
+
+            horizontal_positive = ((horizontal_positive << 1) | 1) & mask
+            horizontal_negative = (horizontal_negative << 1) & mask
+            vertical_positive = horizontal_negative | (~(vertical_x | horizontal_positive) & mask)
+            vertical_negative = horizontal_positive & vertical_x
+
+            if max_distance is not None and distance - (len(target) - target_index - 1) > max_distance:
+                return max_distance + 1
+
+        return distance
+
+    def calculate_distance_anti_diagonal(self, source, target):
+        source_ids, target_ids = self.encode_source_and_target(source, target)
+        last_row = self.calculate_last_row(source_ids, target_ids)
+        # A Python number, the compact stage dtype would wrap around in arithmetic of callers (e.g. summing distances).
+        return last_row[-1].item()
+
+    def encode_source_and_target(self, source, target):
+        if is_encoded(source) and is_encoded(target):
+            return source, target
+
+        if self.vocabulary is None:
+            # Int arrays are plain elements here, a fresh vocabulary interns both sides alike.
+            vocabulary = Vocabulary()
+            return vocabulary.encode(source), vocabulary.encode(target)
+
+        # If only one side is encoded by self.vocabulary, only the other one is encoded, its ids must not be interned again.
+        if not is_encoded(source):
+            source = self.vocabulary.encode(source)
+        if not is_encoded(target):
+            target = self.vocabulary.encode(target)
+        return source, target
+
+    def calculate_last_row(self, source_ids, target_ids):
+        # Cells on the anti-diagonal (i + j == d) only depend on the anti-diagonals d-1 and d-2,
+        # so each anti-diagonal is computed by one vectorized step and only three of them are kept.
+        # Diagonals are indexed by the source stage index i.
+        source_length, target_length = len(source_ids), len(target_ids)
+        stage_dtype = self.get_stage_dtype(source_length, target_length)
+        last_row = numpy.zeros(target_length + 1, dtype=stage_dtype)
+        previous_previous_diagonal = numpy.zeros(source_length + 1, dtype=stage_dtype)
+        previous_diagonal = numpy.zeros(source_length + 1, dtype=stage_dtype)
+        current_diagonal = numpy.zeros(source_length + 1, dtype=stage_dtype)
+        deletion_boundary = self.calculate_boundary(source_length, self.deletion_weight, stage_dtype)
+        insertion_boundary = self.calculate_boundary(target_length, self.insertion_weight, stage_dtype)
+
+        for diagonal_index in range(source_length + target_length + 1):
+            if diagonal_index <= target_length:
+                current_diagonal[0] = insertion_boundary[diagonal_index]
+            if diagonal_index <= source_length:
+                current_diagonal[diagonal_index] = deletion_boundary[diagonal_index]
+
+            lower = max(1, diagonal_index - target_length)
+            upper = min(source_length, diagonal_index - 1)
+            if lower <= upper:
+                source_slice = source_ids[lower-1:upper]
+                target_slice = target_ids[diagonal_index-upper-1:diagonal_index-lower][::-1]
+                matching = previous_previous_diagonal[lower-1:upper]
+                deletion = previous_diagonal[lower-1:upper] + self.deletion_weight
+                insertion = previous_diagonal[lower:upper+1] + self.insertion_weight
+                substitution = matching + self.substitution_weight
+                current_diagonal[lower:upper+1] = numpy.where(
+                    source_slice == target_slice,
+                    matching,
+                    numpy.minimum(numpy.minimum(deletion, insertion), substitution)
+                )
+
+            if source_length <= diagonal_index:
+                last_row[diagonal_index - source_length] = current_diagonal[source_length]
+
+            previous_previous_diagonal, previous_diagonal, current_diagonal = previous_diagonal, current_diagonal, previous_previous_diagonal
+
+        return last_row
+
+    def calculate_distance_banded(self, source, target, max_distance):
+        # Ukkonen's cut-off: a cell (i, j) costs at least |i - j| insertions or deletions,
+        # so only the diagonal band |i - j| <= max_distance / min(deletion_weight, insertion_weight) needs to be evaluated.
+        # All values are clipped to max_distance + 1, which is returned as the sentinel of 'greater than max_distance'.
+        assert max_distance >= 0, f'Invalid max distance: \'{max_distance}\''
+        exceeded_distance = max_distance + 1
+        source_length, target_length = len(source), len(target)
+
+        minimum_weight = min(self.deletion_weight, self.insertion_weight)
+        if minimum_weight > 0:
+            band = int(max_distance // minimum_weight)
+        else:
+            band = max(source_length, target_length)
+
+        if abs(source_length - target_length) > band:
+            return exceeded_distance
+
+        # With unit weights the bit-parallel engine with its own cut-off is faster than the band at any length
+        # (1 edit, max_distance=2: 0.02ms vs 0.32ms at n=30, 2.7ms vs 20ms at n=2000). With other weights the band is faster
+        # than the anti-diagonal engine from about n=30 on (0.32ms vs 0.38ms at n=30, 20ms vs 38ms at n=2000).
+        if self.unit_weights:
+            try:
+                return self.calculate_distance_bit_parallel(source, target, max_distance=max_distance)
+            except TypeError:
+                pass
+
+        try:
+            source_ids, target_ids = self.encode_source_and_target(source, target)
+        except TypeError:
+            band = target_length
+
+        if 2 * band + 1 >= target_length + 1:
+            distance = self.calculate_distance(source, target)
+            if distance > max_distance:
+                return exceeded_distance
+            else:
+                return distance
+
+        if self.integral_weights:
+            dtype = numpy.int64
+        else:
+            dtype = numpy.float64
+
+        previous_lower, previous_upper = 0, min(target_length, band)
+        previous_row = numpy.minimum(numpy.arange(previous_upper + 1, dtype=dtype) * self.insertion_weight, exceeded_distance)
+        for source_stage_index in range(1, source_length + 1):
+            lower = max(0, source_stage_index - band)
+            upper = min(target_length, source_stage_index + band)
+
+            # Columns [start-1, upper] of the previous row, cells out of its band are treated as exceeded.
+            start = max(lower, 1)
+            previous_padded = numpy.full(upper - start + 2, exceeded_distance, dtype=dtype)
+            overlap_lower, overlap_upper = max(start - 1, previous_lower), min(upper, previous_upper)
+            previous_padded[overlap_lower-start+1:overlap_upper-start+2] = previous_row[overlap_lower-previous_lower:overlap_upper-previous_lower+1]
+            diagonal = previous_padded[:-1]
+            vertical = previous_padded[1:]
+
+            current_row = numpy.where(
+                source_ids[source_stage_index-1] == target_ids[start-1:upper],
+                diagonal,
+                numpy.minimum(vertical + self.deletion_weight, diagonal + self.substitution_weight)
+            )
+            if lower == 0:
+                current_row = numpy.concatenate([numpy.array([source_stage_index * self.deletion_weight], dtype=dtype), current_row])
+
+            # Insertions chain from left to right: D[j] = min_{l<=j} (X[l] + (j-l) * insertion_weight).
+            insertion_offsets = numpy.arange(len(current_row), dtype=dtype) * self.insertion_weight
+            current_row = numpy.minimum.accumulate(current_row - insertion_offsets) + insertion_offsets
+            current_row = numpy.minimum(current_row, exceeded_distance)
+
+            if current_row.min() >= exceeded_distance:
+                return exceeded_distance
+
+            previous_lower, previous_upper, previous_row = lower, upper, current_row
+
+        distance = previous_row[target_length - previous_lower]
+        if distance > max_distance:
+            return exceeded_distance
+        else:
+            return distance.item()
+
+    def get_levenshtein_distance(self, source, target, max_distance=None):
+        # If max_distance is given, max_distance + 1 is returned for all pairs whose distance is greater than max_distance.
+        if max_distance is None:
+            return self.calculate_distance(source, target)
+        else:
+            return self.calculate_distance_banded(source, target, max_distance)
+
+    def batch_distance(self, sources, targets, number_worker=1, chunk_size=1000, level=None, max_distance=None):
+        # Pairs are read from the iterables chunk by chunk, and at most 2 * number_worker chunks are in flight,
+        # so the corpus is never held in memory. Distances keep the order of the input pairs.
+        # level: None - elements are compared as given; 'word' - strings are split by whitespace; 'char' - strings are split into characters.
+        # max_distance: see get_levenshtein_distance.
+        assert number_worker > 0, f'Invalid number of worker: \'{number_worker}\''
+        assert chunk_size > 0, f'Invalid size of chunk: \'{chunk_size}\''
+        assert level in {None, 'word', 'char'}, f'Invalid level of tokenization: \'{level}\' (Ops: [None, \'word\', \'char\'])'
+
+        chunks = chunk_pairs(sources, targets, chunk_size)
+        chunk_results = list(process_chunks(calculate_chunk_distances, chunks, dict(levenshtein=self, level=level, max_distance=max_distance), number_worker))
+
+        if len(chunk_results) == 0:
+            distances = numpy.zeros(0, dtype=numpy.float64)
+        else:
+            distances = numpy.concatenate([distances for distances, _, _ in chunk_results])
+
+        return dict(
+            distances=distances,
+            total_distance=distances.sum(),
+            total_source_length=sum(total_source_length for _, total_source_length, _ in chunk_results),
+            total_target_length=sum(total_target_length for _, _, total_target_length in chunk_results),
+            pair_number=len(distances)
+        )
+
+    def accumulate_manipulation_statistics(self, source, target, manipulation_statistics=None, alignment_mode='auto', random_generator=None, vocabulary=None):
+        # Count manipulations while walking the backtrace, without building the manipulation and aligned sequences.
+        # Confusions of encoded sources and targets are keyed by their elements, decoded by vocabulary (default: self.vocabulary),
+        # so that statistics of different vocabularies (e.g. copies in worker processes) can be summed up.
+        if vocabulary is None:
+            vocabulary = self.vocabulary
+        if manipulation_statistics is None:
+            manipulation_statistics = ManipulationStatistics()
+
+        if alignment_mode == 'linear' or (alignment_mode == 'auto' and (len(source) + 1) * (len(target) + 1) > self.linear_memory_threshold):
+            manipulation_sequence = self.calculate_manipulation_sequence(source, target, alignment_mode=alignment_mode, random_generator=random_generator)
+            x, y = 0, 0
+            manipulations = list()
+            for action in manipulation_sequence:
+                if action == constant.MATCHING or action == constant.SUBSTITUTION:
+                    x, y = x + 1, y + 1
+                elif action == constant.DELETION:
+                    x = x + 1
+                elif action == constant.INSERTION:
+                    y = y + 1
+                manipulations.append((action, x, y))
+        else:
+            stage_matrix = self.calculate_stage_matrix(source, target)
+            manipulations = self.walk_manipulations(source, target, stage_matrix, random_generator=random_generator)
+
+        source_elements, target_elements = source, target
+        if vocabulary is not None:
+            if is_encoded(source):
+                source_elements = vocabulary.decode(source)
+            if is_encoded(target):
+                target_elements = vocabulary.decode(target)
+
+        manipulation_counts = dict.fromkeys(candidate_flags, 0)
+        confusions = manipulation_statistics.confusions
+        for action, x, y in manipulations:
+            manipulation_counts[action] += 1
+            if action == constant.SUBSTITUTION:
+                confusions[(source_elements[x-1], target_elements[y-1])] += 1
+
+        for action, count in manipulation_counts.items():
+            manipulation_statistics[action] += count
+
+        return manipulation_statistics
+
+    def batch_manipulation_statistics(self, sources, targets, number_worker=1, chunk_size=1000, level=None, confusion_size=None):
+        # Corpus-level error breakdown: each worker reduces its chunks to one ManipulationStatistics, only those cross processes.
+        # See batch_distance for the arguments.
+        assert number_worker > 0, f'Invalid number of worker: \'{number_worker}\''
+        assert chunk_size > 0, f'Invalid size of chunk: \'{chunk_size}\''
+        assert level in {None, 'word', 'char'}, f'Invalid level of tokenization: \'{level}\' (Ops: [None, \'word\', \'char\'])'
+
+        manipulation_statistics = ManipulationStatistics(confusion_size=confusion_size)
+        chunks = chunk_pairs(sources, targets, chunk_size)
+        for chunk_manipulation_statistics in process_chunks(calculate_chunk_manipulation_statistics, chunks, dict(levenshtein=self, level=level, confusion_size=confusion_size), number_worker):
+            manipulation_statistics = manipulation_statistics + chunk_manipulation_statistics
+
+        return manipulation_statistics
+
+    def batch_error_rate(self, sources, targets, number_worker=1, chunk_size=1000, level='word'):
+        # Corpus-level error rate: the sum of distances divided by the total length of targets (references).
+        # level='word' gives WER, level='char' gives CER.
+        batch_result = self.batch_distance(sources, targets, number_worker=number_worker, chunk_size=chunk_size, level=level)
+        if batch_result['total_target_length'] == 0:
+            return 0.0
+        else:
+            return float(batch_result['total_distance'] / batch_result['total_target_length'])
+
+    def calculate_manipulation_sequence(self, source, target, alignment_mode='auto', random_generator=None):
+        # alignment_mode: 'full' - backtrack on the full stage matrix; 'linear' - Hirschberg's divide-and-conquer in O(n+m) memory;
+        # 'auto' - 'linear' when the stage matrix has more cells than linear_memory_threshold, otherwise 'full'.
+        assert alignment_mode in {'auto', 'full', 'linear'}, f'Invalid alignment mode: \'{alignment_mode}\' (Ops: [\'auto\', \'full\', \'linear\'])'
+        if alignment_mode == 'auto':
+            if (len(source) + 1) * (len(target) + 1) > self.linear_memory_threshold:
+                alignment_mode = 'linear'
+            else:
+                alignment_mode = 'full'
+
+        if alignment_mode == 'linear':
+            try:
+                source_ids, target_ids = self.encode_source_and_target(source, target)
+            except TypeError:
+                alignment_mode = 'full'
+
+        if alignment_mode == 'full':
+            stage_matrix = self.calculate_stage_matrix(source, target)
+            manipulation_sequence = self.backtrack_manipulation_sequence(source, target, stage_matrix, random_generator=random_generator)
+        else:
+            manipulation_sequence = self.calculate_manipulation_sequence_linear(source, target, source_ids, target_ids, random_generator=random_generator)
+
+        return manipulation_sequence
+
+    def calculate_manipulation_sequence_linear(self, source, target, source_ids, target_ids, random_generator=None):
+        # Sub-problems are split in half along the source until their stage matrices fit the linear_memory_threshold.
+        if (len(source) + 1) * (len(target) + 1) <= self.linear_memory_threshold or len(source) <= 1:
+            stage_matrix = self.calculate_stage_matrix(source, target)
+            return self.backtrack_manipulation_sequence(source, target, stage_matrix, random_generator=random_generator)
+
+        source_middle = len(source) // 2
+        forward_last_row = self.calculate_last_row(source_ids[:source_middle], target_ids)
+        backward_last_row = self.calculate_last_row(source_ids[source_middle:][::-1], target_ids[::-1])
+        # Both rows are promoted before adding, since their compact dtypes only fit each half on its own.
+        split_costs = forward_last_row.astype(numpy.result_type(forward_last_row.dtype, numpy.int64)) + backward_last_row[::-1]
+        target_middle = int(numpy.argmin(split_costs))
+
+        former_manipulation_sequence = self.calculate_manipulation_sequence_linear(
+            source[:source_middle], target[:target_middle],
+            source_ids[:source_middle], target_ids[:target_middle],
+            random_generator=random_generator
+        )
+        latter_manipulation_sequence = self.calculate_manipulation_sequence_linear(
+            source[source_middle:], target[target_middle:],
+            source_ids[source_middle:], target_ids[target_middle:],
+            random_generator=random_generator
+        )
+        return former_manipulation_sequence + latter_manipulation_sequence
+
+    def calculate_manipulation_cost(self, manipulation_sequence):
+        manipulation_weights = {
+            constant.MATCHING : 0,
+            constant.DELETION : self.deletion_weight,
+            constant.INSERTION : self.insertion_weight,
+            constant.SUBSTITUTION : self.substitution_weight
+        }
+        return sum(manipulation_weights[action] for action in manipulation_sequence)
 
-    def get_manipulation_sequence(self, source, target):
-        stage_matrix = self.calculate_stage_matrix(source, target)
-        manipulation_sequence = self.backtrack_manipulation_sequence(source, target, stage_matrix)
+    def get_manipulation_sequence(self, source, target, alignment_mode='auto', random_generator=None):
+        manipulation_sequence = self.calculate_manipulation_sequence(source, target, alignment_mode=alignment_mode, random_generator=random_generator)
         return manipulation_sequence
 
-    def get_aligned_sequences(self, source, target):
-        stage_matrix = self.calculate_stage_matrix(source, target)
-        manipulation_sequence = self.backtrack_manipulation_sequence(source, target, stage_matrix)
+    def get_aligned_sequences(self, source, target, alignment_mode='auto', random_generator=None):
+        manipulation_sequence = self.calculate_manipulation_sequence(source, target, alignment_mode=alignment_mode, random_generator=random_generator)
         aligned_source, aligned_target = self.align_source_and_target(source, target, manipulation_sequence)
         return dict(
             aligned_source=aligned_source,
             aligned_target=aligned_target,
             manipulation=manipulation_sequence
         )
+
+    def get_levenshtein_results(self, source, target, alignment_mode='auto', random_generator=None):
+        # Distance, Manipulation-Sequence and Aligned-Sequences from a single computation of the stage matrix.
+        # The distance is the cost of the optimal manipulation sequence, which equals the last cell of the stage matrix.
+        manipulation_sequence = self.calculate_manipulation_sequence(source, target, alignment_mode=alignment_mode, random_generator=random_generator)
+        aligned_source, aligned_target = self.align_source_and_target(source, target, manipulation_sequence)
+        return dict(
+            distance=self.calculate_manipulation_cost(manipulation_sequence),
+            aligned_source=aligned_source,
+            aligned_target=aligned_target,
+            manipulation=manipulation_sequence
+        )
+
+
+class BKTree(object):
+    # Burkhard-Keller tree for approximate lookup. Every element in the subtree under the edge 'c' of a node
+    # has distance c to that node, so by the triangle inequality only edges within [d-k, d+k] need to be visited.
+    # Nodes are kept in flat lists (no nested objects), so that a large tree can be dumped by yoolkit.cio.dump_data.
+    def __init__(self, levenshtein=None, elements=None):
+        if levenshtein is None:
+            levenshtein = Levenshtein()
+        assert levenshtein.deletion_weight == levenshtein.insertion_weight, 'Levenshtein-Distance is not symmetric if deletion weight != insertion weight.'
+        self.levenshtein = levenshtein
+        self.elements = list()
+        self.children = list()
+        if elements is not None:
+            for element in elements:
+                self.add(element)
+
+    def __len__(self):
+        return len(self.elements)
+
+    def calculate_distance(self, source, target, max_distance=None):
+        return self.levenshtein.get_levenshtein_distance(source, target, max_distance=max_distance)
+
+    def add(self, element):
+        if len(self.elements) == 0:
+            self.elements.append(element)
+            self.children.append(dict())
+            return True
+
+        node_index = 0
+        while True:
+            distance = self.calculate_distance(element, self.elements[node_index])
+            if distance == 0:
+                return False
+            if distance in self.children[node_index]:
+                node_index = self.children[node_index][distance]
+            else:
+                self.children[node_index][distance] = len(self.elements)
+                self.elements.append(element)
+                self.children.append(dict())
+                return True
+
+    def query(self, element, max_distance):
+        # Return all (distance, element) within max_distance, sorted by distance.
+        results = list()
+        if len(self.elements) == 0:
+            return results
+
+        node_indices = [0]
+        while len(node_indices) != 0:
+            node_index = node_indices.pop()
+            children = self.children[node_index]
+            # Exact distances are only needed up to the farthest reachable edge, the rest is cut off by the banded engine.
+            cut_off_distance = max(children.keys(), default=0) + max_distance
+            distance = self.calculate_distance(element, self.elements[node_index], max_distance=cut_off_distance)
+            if distance <= max_distance:
+                results.append((distance, node_index))
+            if distance > cut_off_distance:
+                continue
+            for edge_distance, child_index in children.items():
+                if distance - max_distance <= edge_distance <= distance + max_distance:
+                    node_indices.append(child_index)
+
+        results.sort()
+        return [(distance, self.elements[node_index]) for distance, node_index in results]
+
+    def nearest(self, element, k=1):
+        # Return the k nearest (distance, element), sorted by distance. Subtrees are visited best-first by their lower bounds.
+        assert k > 0, f'Invalid k: \'{k}\''
+        results = list()
+        if len(self.elements) == 0:
+            return results
+
+        candidates = [(0, 0)]
+        while len(candidates) != 0:
+            lower_bound, node_index = heapq.heappop(candidates)
+            if len(results) == k and lower_bound > -results[0][0]:
+                break
+
+            distance = self.calculate_distance(element, self.elements[node_index])
+            if len(results) < k:
+                heapq.heappush(results, (-distance, -node_index))
+            elif distance < -results[0][0]:
+                heapq.heapreplace(results, (-distance, -node_index))
+
+            if len(results) == k:
+                radius = -results[0][0]
+            else:
+                radius = float('inf')
+            for edge_distance, child_index in self.children[node_index].items():
+                child_lower_bound = max(lower_bound, abs(distance - edge_distance))
+                if child_lower_bound <= radius:
+                    heapq.heappush(candidates, (child_lower_bound, child_index))
+
+        results = sorted((-distance, -node_index) for distance, node_index in results)
+        return [(distance, self.elements[node_index]) for distance, node_index in results]
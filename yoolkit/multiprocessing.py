@@ -10,18 +10,84 @@
 # LICENSE file in the root directory of this source tree.
 
 
+import os
+import math
+import queue
+import atexit
+import pickle
+import asyncio
+import inspect
+import threading
+import statistics
+import functools
+import itertools
+import collections
 import multiprocessing
+import multiprocessing.pool
+
+from yoolkit.cio import split_plain, load_range_lines, dump_data, load_data
+from yoolkit.timer import Timer
+from yoolkit.logging import get_logger
+
+
+pool_dict = dict()
+
+
+backends = {'process', 'thread', 'asyncio'}
+
+
+# State of the current worker (a process, or a thread of the 'thread' backend), returned by the initializer of its pool (see setup_pool).
+worker_state = threading.local()
+
+
+def count_cgroup_cpu():
+    # CPU quota of the container: cgroup v2 (cpu.max) first, then cgroup v1 (cpu.cfs_quota_us / cpu.cfs_period_us).
+    # Return None if there is no quota or no cgroup filesystem.
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as cpu_max_file:
+            quota, period = cpu_max_file.read().split()[:2]
+        if quota == 'max':
+            return None
+        quota, period = int(quota), int(period)
+    except (OSError, ValueError):
+        for cgroup_dir in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+            try:
+                with open(os.path.join(cgroup_dir, 'cpu.cfs_quota_us'), 'r') as quota_file:
+                    quota = int(quota_file.read())
+                with open(os.path.join(cgroup_dir, 'cpu.cfs_period_us'), 'r') as period_file:
+                    period = int(period_file.read())
+                break
+            except (OSError, ValueError):
+                continue
+        else:
+            return None
+
+    if quota <= 0 or period <= 0:
+        return None
+    return max(math.ceil(quota / period), 1)
 
 
 def count_cpu():
-    return multiprocessing.cpu_count()
+    # CPUs this process may actually use: its affinity mask (e.g. taskset, Slurm) bounded by the cgroup quota (e.g. docker --cpus),
+    # multiprocessing.cpu_count() reports all CPUs of the host and oversubscribes containers.
+    if hasattr(os, 'sched_getaffinity'):
+        cpu_number = len(os.sched_getaffinity(0))
+    else:
+        cpu_number = multiprocessing.cpu_count()
+
+    cgroup_cpu_number = count_cgroup_cpu()
+    if cgroup_cpu_number is not None:
+        cpu_number = min(cpu_number, cgroup_cpu_number)
+
+    return max(cpu_number, 1)
 
 
-def estimate_chunksize(iterator_length=None, factor=4):
+def estimate_chunksize(iterator_length=None, factor=4, number_worker=None):
     if iterator_length is None:
         chunksize = 1
     else:
-        number_worker = count_cpu()
+        if number_worker is None:
+            number_worker = count_cpu()
 
         quotient, remainder = divmod(iterator_length, number_worker * factor)
 
@@ -30,17 +96,488 @@ def estimate_chunksize(iterator_length=None, factor=4):
         else:
             chunksize = quotient + 1
 
-    return chunksize
+    return max(chunksize, 1)
+
+
+class AdaptiveChunksize(object):
+    # Chunksize retuned from the measured time per item, so that a chunk takes about target_task_duration seconds in a worker:
+    # long enough to amortize the IPC of each task, short enough to balance the load. It starts from 1 item per chunk.
+    def __init__(self, target_task_duration, max_chunksize=None, smoothing_factor=0.5, max_growth=4):
+        assert target_task_duration > 0, f'Invalid target task duration: \'{target_task_duration}\''
+        self.target_task_duration = target_task_duration
+        self.max_chunksize = max_chunksize
+        self.smoothing_factor = smoothing_factor
+        self.max_growth = max_growth
+        self.item_duration = None
+        self.chunksize = 1
+
+    def update(self, item_number, elapsed_time):
+        if item_number == 0:
+            return
+        item_duration = elapsed_time / item_number
+        if self.item_duration is None:
+            self.item_duration = item_duration
+        else:
+            self.item_duration = self.smoothing_factor * item_duration + (1 - self.smoothing_factor) * self.item_duration
+
+        if self.item_duration > 0:
+            chunksize = int(self.target_task_duration / self.item_duration)
+        else:
+            chunksize = self.chunksize * self.max_growth
+        chunksize = min(chunksize, self.chunksize * self.max_growth)
+        if self.max_chunksize is not None:
+            chunksize = min(chunksize, self.max_chunksize)
+        self.chunksize = max(chunksize, 1)
+
+
+def process_chunk(method, chunk):
+    timer = Timer()
+    timer.launch()
+    results = [method(item) for item in chunk]
+    return results, timer.standby()
+
+
+def process_measured_chunk(method, chunk_bytes):
+    # As process_chunk, but the chunk and its results are (de)serialized here, so that the parent learns the bytes sent each way.
+    timer = Timer()
+    timer.launch()
+    results = [method(item) for item in pickle.loads(chunk_bytes)]
+    results_bytes = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+    return results_bytes, timer.standby(), get_worker_id(), len(chunk_bytes)
+
+
+def get_worker_id():
+    # Tasks of a process worker run in its main thread, those of the 'thread' backend do not.
+    if threading.current_thread() is threading.main_thread():
+        return os.getpid()
+    else:
+        return threading.get_ident()
+
+
+async def process_coroutine_chunk(method, chunk, semaphore):
+    async def process_item(item):
+        async with semaphore:
+            return await method(item)
+
+    timer = Timer()
+    timer.launch()
+    results = await asyncio.gather(*[process_item(item) for item in chunk])
+    return list(results), timer.standby()
+
+
+class AsyncResult(object):
+    def __init__(self, future):
+        self.future = future
+
+    def get(self, timeout=None):
+        return self.future.result(timeout)
+
+
+class AsyncioPool(object):
+    # The part of the multiprocessing.Pool interface used by imap_pool, over an event loop running in a background thread.
+    # Tasks are coroutine chunk functions (see process_coroutine_chunk) receiving self.semaphore as their last argument,
+    # so at most concurrency_limit coroutines of the mapped method are running at once across all chunks.
+    def __init__(self, concurrency_limit):
+        assert concurrency_limit > 0, f'Invalid concurrency limit: \'{concurrency_limit}\''
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.semaphore = asyncio.run_coroutine_threadsafe(self.create_semaphore(concurrency_limit), self.loop).result()
+
+    @staticmethod
+    async def create_semaphore(concurrency_limit):
+        return asyncio.Semaphore(concurrency_limit)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        future = asyncio.run_coroutine_threadsafe(func(*args, self.semaphore), self.loop)
+
+        def done_callback(future):
+            if future.cancelled():
+                return
+            exception = future.exception()
+            if exception is None:
+                if callback is not None:
+                    callback(future.result())
+            else:
+                if error_callback is not None:
+                    error_callback(exception)
+
+        future.add_done_callback(done_callback)
+        return AsyncResult(future)
+
+    def close(self):
+        pass
+
+    def join(self):
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def terminate(self):
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.cancel_tasks(), self.loop).result()
+        self.join()
+
+    @staticmethod
+    async def cancel_tasks():
+        # Cancelled tasks are awaited, so that none is still pending when the loop stops.
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.terminate()
+
+
+def create_pool(number_worker, backend='process', initializer=None, initializer_arguments=()):
+    # backend: 'process' for CPU-bound methods; 'thread' (multiprocessing.pool.ThreadPool) for I/O-bound methods, without forking
+    # and pickling; 'asyncio' for coroutine functions, number_worker is then the limit of concurrent coroutines.
+    assert backend in backends, f'Invalid backend: \'{backend}\', supported: {sorted(backends)}'
+    if backend == 'asyncio':
+        assert initializer is None, 'Initializer is not supported by the \'asyncio\' backend'
+        return AsyncioPool(number_worker)
+
+    if backend == 'process':
+        pool_class = multiprocessing.Pool
+    else:
+        pool_class = multiprocessing.pool.ThreadPool
+    if initializer is None:
+        return pool_class(number_worker)
+    else:
+        return pool_class(number_worker, initializer=initialize_worker, initargs=(initializer, initializer_arguments))
+
+
+class PoolMetrics(object):
+    # Throughput and utilization of multi_process_imap / multi_process(..., metrics=PoolMetrics(...)):
+    # busy and idle time of each worker, items per second, queue depth (chunks submitted but not yet yielded),
+    # serialized bytes sent to and received from workers, and straggler chunks whose time per item exceeds
+    # straggler_factor times the mean. Every report_interval seconds (and at the end) summary() is passed to callback
+    # and/or logged by the yoolkit.logging logger named logger_name. Without metrics none of this is measured.
+    # Not supported by the 'asyncio' backend: its chunks share one event loop thread, there are no workers to measure.
+    def __init__(self, report_interval=10, callback=None, logger_name=None, straggler_factor=4, max_straggler_number=16):
+        assert report_interval > 0, f'Invalid report interval: \'{report_interval}\''
+        self.report_interval = report_interval
+        self.callback = callback
+        self.logger_name = logger_name
+        self.straggler_factor = straggler_factor
+        self.max_straggler_number = max_straggler_number
+        self.start(0)
+
+    def start(self, number_worker):
+        self.timer = Timer()
+        self.timer.launch()
+        self.last_report_time = 0
+        self.number_worker = number_worker
+        self.worker_busy_time = collections.defaultdict(float)
+        self.worker_item_number = collections.defaultdict(int)
+        self.item_number = 0
+        self.chunk_number = 0
+        self.sent_bytes = 0
+        self.received_bytes = 0
+        self.queue_depth = 0
+        self.queue_depths = list()
+        self.stragglers = list()
+
+    def record_queue_depth(self, queue_depth):
+        self.queue_depth = queue_depth
+        self.queue_depths.append(queue_depth)
+
+    def record_chunk(self, worker_id, item_number, busy_time, sent_bytes, received_bytes):
+        # Stragglers are only judged after every worker could have finished a chunk, the mean is not settled before.
+        mean_item_time = sum(self.worker_busy_time.values()) / self.item_number if self.item_number else 0
+        if self.chunk_number >= self.number_worker and item_number != 0 and busy_time / item_number > self.straggler_factor * mean_item_time:
+            if len(self.stragglers) == self.max_straggler_number:
+                self.stragglers.pop(0)
+            self.stragglers.append(dict(worker_id=worker_id, item_number=item_number, busy_time=busy_time, mean_item_time=mean_item_time))
+
+        self.worker_busy_time[worker_id] += busy_time
+        self.worker_item_number[worker_id] += item_number
+        self.item_number += item_number
+        self.chunk_number += 1
+        self.sent_bytes += sent_bytes
+        self.received_bytes += received_bytes
+
+        if self.timer.elapsed_time - self.last_report_time >= self.report_interval:
+            self.report()
+
+    def summary(self):
+        elapsed_time = self.timer.elapsed_time
+        busy_time = sum(self.worker_busy_time.values())
+        return dict(
+            elapsed_time=elapsed_time,
+            item_number=self.item_number,
+            chunk_number=self.chunk_number,
+            items_per_second=self.item_number / elapsed_time if elapsed_time else 0,
+            utilization=busy_time / (elapsed_time * self.number_worker) if elapsed_time and self.number_worker else 0,
+            workers={
+                worker_id: dict(
+                    busy_time=worker_busy_time,
+                    idle_time=max(elapsed_time - worker_busy_time, 0),
+                    item_number=self.worker_item_number[worker_id]
+                )
+                for worker_id, worker_busy_time in self.worker_busy_time.items()
+            },
+            unused_worker_number=max(self.number_worker - len(self.worker_busy_time), 0),
+            queue_depth=self.queue_depth,
+            max_queue_depth=max(self.queue_depths, default=0),
+            mean_queue_depth=statistics.mean(self.queue_depths) if self.queue_depths else 0,
+            sent_bytes=self.sent_bytes,
+            received_bytes=self.received_bytes,
+            stragglers=list(self.stragglers)
+        )
+
+    def report(self):
+        self.last_report_time = self.timer.elapsed_time
+        summary = self.summary()
+        if self.callback is not None:
+            self.callback(summary)
+        if self.logger_name is not None:
+            get_logger(self.logger_name).info(
+                f'[multi_process] {summary["item_number"]} items in {summary["elapsed_time"]:.1f}s '
+                f'({summary["items_per_second"]:.1f} items/s); '
+                f'utilization: {summary["utilization"]:.1%} of {self.number_worker} workers '
+                f'({summary["unused_worker_number"]} unused); '
+                f'queue depth: {summary["queue_depth"]} (max {summary["max_queue_depth"]}, mean {summary["mean_queue_depth"]:.1f}); '
+                f'sent: {summary["sent_bytes"] / (1024 * 1024):.1f}MB, received: {summary["received_bytes"] / (1024 * 1024):.1f}MB; '
+                f'stragglers: {len(summary["stragglers"])}'
+            )
+
+    def finish(self):
+        self.timer.standby()
+        self.report()
+
+
+def chunk_iterator(iterator, chunksize):
+    # chunksize: an int, or an AdaptiveChunksize whose current value is read before each chunk.
+    iterator = iter(iterator)
+    while True:
+        if isinstance(chunksize, AdaptiveChunksize):
+            chunk = list(itertools.islice(iterator, chunksize.chunksize))
+        else:
+            chunk = list(itertools.islice(iterator, chunksize))
+        if len(chunk) == 0:
+            break
+        else:
+            yield chunk
+
+
+def initialize_worker(initializer, initializer_arguments):
+    worker_state.state = initializer(*initializer_arguments)
+
+
+def get_worker_state():
+    return getattr(worker_state, 'state', None)
+
+
+def setup_pool(name, number_worker=None, initializer=None, initializer_arguments=(), backend='process'):
+    # Create a persistent pool registered by name, it is reused by multi_process(..., pool_name=name) until close_pool(name).
+    # initializer(*initializer_arguments) runs once in each worker, and its return value (e.g. a loaded vocabulary or
+    # a Levenshtein object) stays resident in the worker: methods read it by get_worker_state() instead of receiving it per task.
+    if name in pool_dict:
+        close_pool(name)
+    if number_worker is None:
+        number_worker = count_cpu()
+    pool = create_pool(number_worker, backend, initializer, initializer_arguments)
+    pool_dict[name] = (pool, number_worker)
+    return pool
+
+
+def get_pool(name):
+    # Unregistered names are an error rather than a default pool: a typo would otherwise run without the initializer of the intended pool.
+    if name not in pool_dict:
+        raise KeyError(f'Pool \'{name}\' is not set up, call setup_pool(\'{name}\', ...) first (registered: {sorted(pool_dict)})')
+    pool, _ = pool_dict[name]
+    return pool
+
+
+def close_pool(name):
+    if name in pool_dict:
+        pool, _ = pool_dict.pop(name)
+        pool.close()
+        pool.join()
+
+
+@atexit.register
+def close_pools():
+    for name in list(pool_dict):
+        close_pool(name)
+
+
+def imap_pool(pool, method, iterator, number_worker, chunksize, ordered, max_inflight_chunk, metrics=None):
+    if metrics is not None:
+        metrics.start(number_worker)
+
+    if isinstance(pool, AsyncioPool):
+        assert inspect.iscoroutinefunction(method), 'Method of the \'asyncio\' backend must be a coroutine function'
+        # All chunks share one event loop thread, so there are no workers whose busy and idle time could be measured.
+        assert metrics is None, 'Metrics are not supported by the \'asyncio\' backend'
+        chunk_method = process_coroutine_chunk
+    else:
+        chunk_method = process_chunk
+
+    def submit(chunk, callback=None, error_callback=None):
+        if metrics is None:
+            return pool.apply_async(chunk_method, (method, chunk), callback=callback, error_callback=error_callback)
+        else:
+            chunk_bytes = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+            return pool.apply_async(process_measured_chunk, (method, chunk_bytes), callback=callback, error_callback=error_callback)
+
+    def unpack(chunk_result, inflight_chunk):
+        if metrics is None:
+            results, elapsed_time = chunk_result
+        else:
+            results_bytes, elapsed_time, worker_id, chunk_bytes_number = chunk_result
+            results = pickle.loads(results_bytes)
+            metrics.record_queue_depth(inflight_chunk)
+            metrics.record_chunk(worker_id, len(results), elapsed_time, chunk_bytes_number, len(results_bytes))
+        if isinstance(chunksize, AdaptiveChunksize):
+            chunksize.update(len(results), elapsed_time)
+        return results
+
+    if ordered:
+        async_processes = collections.deque()
+        for chunk in chunk_iterator(iterator, chunksize):
+            if len(async_processes) == max_inflight_chunk:
+                yield from unpack(async_processes.popleft().get(), len(async_processes))
+            async_processes.append(submit(chunk))
+            if metrics is not None:
+                metrics.record_queue_depth(len(async_processes))
+
+        while len(async_processes) != 0:
+            yield from unpack(async_processes.popleft().get(), len(async_processes))
+
+    else:
+        # Callbacks run in a thread of the pool, results are handed over by a queue.
+        chunk_results = queue.Queue()
+        inflight_chunk = 0
+        for chunk in chunk_iterator(iterator, chunksize):
+            if inflight_chunk == max_inflight_chunk:
+                success, chunk_result = chunk_results.get()
+                inflight_chunk -= 1
+                if not success:
+                    raise chunk_result
+                yield from unpack(chunk_result, inflight_chunk)
+            submit(
+                chunk,
+                callback=lambda chunk_result: chunk_results.put((True, chunk_result)),
+                error_callback=lambda exception: chunk_results.put((False, exception))
+            )
+            inflight_chunk += 1
+            if metrics is not None:
+                metrics.record_queue_depth(inflight_chunk)
+
+        while inflight_chunk != 0:
+            success, chunk_result = chunk_results.get()
+            inflight_chunk -= 1
+            if not success:
+                raise chunk_result
+            yield from unpack(chunk_result, inflight_chunk)
+
+    if metrics is not None:
+        metrics.finish()
+
+
+def multi_process_imap(method, iterator, number_worker=None, chunksize=None, ordered=True, max_inflight_chunk=None, pool_name=None, target_task_duration=0.2, metrics=None, backend='process'):
+    # Yield method(item) for items of iterator while it is still being consumed.
+    # Items are sent to workers in chunks (chunksize=None: estimate_chunksize(len(iterator), number_worker=number_worker) if the iterator has a length, otherwise 1),
+    # and at most max_inflight_chunk (default: 2 * number_worker) chunks are submitted but not yet yielded, so memory stays bounded.
+    # chunksize='adaptive': start from 1 item per chunk and retune it from the measured time per item toward chunks of
+    # target_task_duration seconds (see AdaptiveChunksize), bounded by 1/4 of the share of each worker if the iterator has a length.
+    # ordered: results follow the order of items; otherwise they are yielded as soon as their chunks are done.
+    # pool_name: run on the persistent pool of this name (see setup_pool) instead of a new pool, number_worker defaults to its size.
+    # metrics: a PoolMetrics that collects and reports throughput and utilization of this run ('process' and 'thread' backends only).
+    # backend: 'process', 'thread' or 'asyncio' (method is a coroutine function, at most number_worker of them run at once),
+    # see create_pool. A persistent pool keeps the backend given to setup_pool.
+    if pool_name is not None:
+        pool = get_pool(pool_name)
+        if number_worker is None:
+            _, number_worker = pool_dict[pool_name]
+    assert number_worker is not None and number_worker > 0, f'Invalid number of worker: \'{number_worker}\''
+    if chunksize is None:
+        chunksize = estimate_chunksize(len(iterator) if hasattr(iterator, '__len__') else None, number_worker=number_worker)
+    if chunksize == 'adaptive':
+        if hasattr(iterator, '__len__'):
+            max_chunksize = max(math.ceil(len(iterator) / (number_worker * 4)), 1)
+        else:
+            max_chunksize = None
+        chunksize = AdaptiveChunksize(target_task_duration, max_chunksize)
+    else:
+        assert chunksize > 0, f'Invalid size of chunk: \'{chunksize}\''
+    if max_inflight_chunk is None:
+        max_inflight_chunk = 2 * number_worker
+    assert max_inflight_chunk > 0, f'Invalid number of inflight chunk: \'{max_inflight_chunk}\''
+
+    if pool_name is None:
+        with create_pool(number_worker, backend) as pool:
+            yield from imap_pool(pool, method, iterator, number_worker, chunksize, ordered, max_inflight_chunk, metrics)
+    else:
+        yield from imap_pool(pool, method, iterator, number_worker, chunksize, ordered, max_inflight_chunk, metrics)
+
+
+def multi_process(method, iterator, number_worker=None, chunksize=None, pool_name=None, target_task_duration=0.2, metrics=None, backend='process'):
+    return list(multi_process_imap(method, iterator, number_worker, chunksize=chunksize, pool_name=pool_name, target_task_duration=target_task_duration, metrics=metrics, backend=backend))
+
+
+def map_reduce_partition(partition, mapper, reducer, file_encoding):
+    # Map and reduce the lines of one byte range inside the worker, so only its partial result is sent back.
+    file_path, start, end = partition
+    partial_result = None
+    for line in load_range_lines(file_path, start, end, file_encoding=file_encoding):
+        mapped_result = mapper(line)
+        if partial_result is None:
+            partial_result = mapped_result
+        else:
+            partial_result = reducer(partial_result, mapped_result)
+    return partition, partial_result
+
+
+def tree_reduce(reducer, results):
+    # Reduce pairwise level by level, which keeps the sizes of both operands balanced (e.g. merging Counters).
+    results = [result for result in results if result is not None]
+    if len(results) == 0:
+        return None
+    while len(results) > 1:
+        reduced_results = [reducer(results[index], results[index + 1]) for index in range(0, len(results) - 1, 2)]
+        if len(results) % 2 == 1:
+            reduced_results.append(results[-1])
+        results = reduced_results
+    return results[0]
+
+
+def map_reduce(file_path, mapper, reducer, number_worker=None, partition_number=None, file_encoding='utf-8', checkpoint_path=None, pool_name=None):
+    # Whole-corpus pass: reducer(... reducer(mapper(line_1), mapper(line_2)) ...) over all lines of file_path,
+    # e.g. mapper returns a yoolkit.statistics.Statistics for a line and reducer is operator.add.
+    # The file is split by split_plain into partition_number (default: 4 * number_worker) byte ranges, each worker reads,
+    # maps and reduces its own ranges, and the partial results are tree-reduced at the end (None if the file is empty).
+    # checkpoint_path: partial results of completed partitions are saved there, and a rerun with the same file and
+    # partition_number skips them, so an interrupted pass resumes from the completed partitions.
+    if pool_name is not None:
+        get_pool(pool_name)
+        if number_worker is None:
+            _, number_worker = pool_dict[pool_name]
+    if number_worker is None:
+        number_worker = count_cpu()
+    if partition_number is None:
+        partition_number = 4 * number_worker
+    partitions = split_plain(file_path, partition_number)
 
+    completed_results = dict()
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        completed_results = load_data(checkpoint_path)
+    pending_partitions = [partition for partition in partitions if partition not in completed_results]
 
-def multi_process(method, iterator, number_worker):
-    process_results = list()
-    with multiprocessing.Pool(number_worker) as pool:
-        async_processes = list()
-        for item in iterator:
-            async_process = pool.apply_async(method, (item,))
-            async_processes.append(async_process)
+    method = functools.partial(map_reduce_partition, mapper=mapper, reducer=reducer, file_encoding=file_encoding)
+    for partition, partial_result in multi_process_imap(method, pending_partitions, number_worker, chunksize=1, ordered=False, pool_name=pool_name):
+        completed_results[partition] = partial_result
+        if checkpoint_path is not None:
+            dump_data(f'{checkpoint_path}.tmp', completed_results)
+            os.replace(f'{checkpoint_path}.tmp', checkpoint_path)
 
-        for async_process in async_processes:
-            process_results.append(async_process.get())
-    return process_results
+    return tree_reduce(reducer, [completed_results[partition] for partition in partitions])
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) Jason Young (杨郑鑫).
+#
+# E-Mail: <AI.Jason.Young@outlook.com>
+# 2020-11-02 02:19
+#
+# This source code is licensed under the WTFPL license found in the
+# LICENSE file in the root directory of this source tree.
+
+
+import sys
+import numpy
+import atexit
+import threading
+
+from multiprocessing import shared_memory, resource_tracker
+
+
+# Shared arrays created (owned) by this process, they are unlinked at exit if they are not unlinked before.
+owned_shared_arrays = dict()
+
+
+# resource_tracker.register is patched while attaching before Python 3.13 (see attach_shared_memory).
+attach_lock = threading.Lock()
+
+
+class SharedArray(object):
+    # A NumPy array in a multiprocessing.shared_memory block. Pickling a SharedArray only sends its handle
+    # (name, shape, dtype), and unpickling attaches to the same block, so tasks of multi_process can pass large arrays
+    # (inputs, or an output preallocated by the parent for workers to write into) without copying them through pipes.
+    # The creating process owns the block: unlink() (or leaving the with-block) frees it, and owned blocks are freed
+    # at exit as well, so segments do not leak even if a worker crashes.
+    def __init__(self, shape, dtype=numpy.float64, name=None):
+        self.shape = tuple(shape) if isinstance(shape, (tuple, list)) else (shape,)
+        self.dtype = numpy.dtype(dtype)
+        if name is None:
+            size = max(int(numpy.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+            owned_shared_arrays[self.shared_memory.name] = self
+        else:
+            self.shared_memory = attach_shared_memory(name)
+            self.owner = False
+        self.array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self.shared_memory.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        shared_array = cls(array.shape, array.dtype)
+        shared_array.array[...] = array
+        return shared_array
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    def __getstate__(self):
+        return dict(shape=self.shape, dtype=self.dtype.str, name=self.name)
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], state['dtype'], name=state['name'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __setitem__(self, index, value):
+        self.array[index] = value
+
+    def close(self):
+        # Views of self.array must not be used after closing.
+        if self.shared_memory is not None:
+            self.array = None
+            self.shared_memory.close()
+
+    def unlink(self):
+        if self.owner and self.shared_memory is not None:
+            owned_shared_arrays.pop(self.shared_memory.name, None)
+            try:
+                self.shared_memory.unlink()
+            except FileNotFoundError:
+                # Already unlinked (e.g. by a resource tracker), only its registration is left to drop.
+                if sys.version_info < (3, 13):
+                    resource_tracker.unregister(self.shared_memory._name, 'shared_memory')
+            self.shared_memory = None
+
+
+def attach_shared_memory(name):
+    # Attached blocks are owned by their creators, since Python 3.13 they can be excluded from the resource tracker.
+    # Before, attaching registers the block with the resource tracker of this process. A worker forked before any tracker
+    # was started (e.g. of a pool made by setup_pool before the SharedArray) gets a tracker of its own, which would unlink
+    # the live block of the owner when the worker exits. Unregistering after attaching is not safe either: a tracker shared
+    # with the owner (inherited by the worker) would drop the registration of the owner. So only the registration of this
+    # block is skipped while attaching, which is what track=False does.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    with attach_lock:
+        register = resource_tracker.register
+
+        def register_except_attached(resource_name, resource_type):
+            if resource_type != 'shared_memory' or resource_name.lstrip('/') != name.lstrip('/'):
+                register(resource_name, resource_type)
+
+        resource_tracker.register = register_except_attached
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def share_array(array):
+    return SharedArray.from_array(array)
+
+
+@atexit.register
+def unlink_shared_arrays():
+    for shared_array in list(owned_shared_arrays.values()):
+        shared_array.close()
+        shared_array.unlink()